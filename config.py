@@ -1,63 +1,164 @@
 """
 config.py  -  All configuration loaded from environment / .env file
+
+The environment is snapshotted once after load_dotenv() and parsed into a
+frozen, slotted Settings object exposed as `settings`; the module-level
+names below are read from it.
 """
 
+import logging
 import os
+import re
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
+# One copy of the environment - plain dict lookups instead of os.environ
+_ENV = dict(os.environ)
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    samsara_api_token:             str | None
+    samsara_base_url:              str
+    telegram_bot_token:            str
+    telegram_group_id:             str
+    data_dir:                      str
+    fuel_alert_threshold_pct:      float
+    pilot_radius_miles:            float
+    loves_radius_miles:            float
+    extended_radius_miles:         float
+    poll_interval_healthy:         int
+    poll_interval_watch:           int
+    poll_interval_critical_moving: int
+    poll_interval_critical_parked: int
+    yards:                         tuple
+    skip_detection_hours:          int
+    visit_radius_miles:            float
+    state_save_interval_seconds:   int
+    process_workers:               int
+
+
+_YARD_KEY_RE = re.compile(r"^YARD_(\d+)$")
+
+
+def _parse_yards(env: dict) -> list:
+    # Format in .env:  YARD_N=Yard Name:latitude:longitude:radius_miles
+    # Example:         YARD_1=Main Yard:28.4277:-81.3816:0.5
+    # Single pass over the snapshot, ordered by N; malformed entries are logged and skipped.
+    numbered = []
+    for key, val in env.items():
+        if not key.startswith("YARD_"):
+            continue
+        km = _YARD_KEY_RE.match(key)
+        val = val.strip()
+        if not km or not val:
+            continue
+        parts = val.split(":")
+        try:
+            if len(parts) != 4:
+                raise ValueError(f"expected 4 ':'-separated fields, got {len(parts)}")
+            yard = {
+                "name":         parts[0].strip(),
+                "lat":          float(parts[1]),
+                "lng":          float(parts[2]),
+                "radius_miles": float(parts[3]),
+            }
+        except ValueError as e:
+            log.warning(f"Skipping malformed {key}={val!r}: {e}")
+            continue
+        numbered.append((int(km.group(1)), yard))
+    numbered.sort(key=lambda item: item[0])
+    return [yard for _, yard in numbered]
+
+
+def _load_settings() -> Settings:
+    """Parse the environment snapshot; called once below to build `settings`."""
+    env = _ENV
+    return Settings(
+        # -- Samsara ----------------------------------------------------------
+        samsara_api_token = env.get("SAMSARA_API_TOKEN"),
+        samsara_base_url  = "https://api.samsara.com",
+
+        # -- Telegram ---------------------------------------------------------
+        telegram_bot_token = env.get("TELEGRAM_BOT_TOKEN", "").strip(),
+        telegram_group_id  = env.get("TELEGRAM_GROUP_ID", "").strip(),
+
+        # -- SQLite -----------------------------------------------------------
+        # Set DATA_DIR to a Railway persistent volume path e.g. /data
+        # Defaults to current directory for local development
+        data_dir = env.get("DATA_DIR", "."),
+
+        # -- Fuel threshold ---------------------------------------------------
+        fuel_alert_threshold_pct = float(env.get("FUEL_ALERT_THRESHOLD_PCT", 30)),
+
+        # -- Stop search radii ------------------------------------------------
+        pilot_radius_miles    = float(env.get("PILOT_RADIUS_MILES",    50)),
+        loves_radius_miles    = float(env.get("LOVES_RADIUS_MILES",    50)),
+        extended_radius_miles = float(env.get("EXTENDED_RADIUS_MILES", 80)),
+
+        # -- Polling intervals (minutes) --------------------------------------
+        poll_interval_healthy         = int(env.get("POLL_INTERVAL_HEALTHY",         60)),
+        poll_interval_watch           = int(env.get("POLL_INTERVAL_WATCH",           20)),
+        poll_interval_critical_moving = int(env.get("POLL_INTERVAL_CRITICAL_MOVING", 10)),
+        poll_interval_critical_parked = int(env.get("POLL_INTERVAL_CRITICAL_PARKED", 60)),
+
+        # -- Yard geofences ---------------------------------------------------
+        yards = tuple(_parse_yards(env)),
+
+        # -- Skip / visit detection -------------------------------------------
+        skip_detection_hours = int(env.get("SKIP_DETECTION_HOURS", 10)),
+        visit_radius_miles   = float(env.get("VISIT_RADIUS_MILES", 0.5)),
+
+        # -- State persistence ------------------------------------------------
+        state_save_interval_seconds = int(env.get("STATE_SAVE_INTERVAL_SECONDS", 300)),
+
+        # -- Concurrency ------------------------------------------------------
+        # Due trucks processed side by side per poll cycle
+        process_workers = max(1, int(env.get("PROCESS_WORKERS", 8))),
+    )
+
+
+# Typed, read-only view of the configuration: `from config import settings`
+settings = _load_settings()
+
 # -- Samsara ------------------------------------------------------------------
-SAMSARA_API_TOKEN = os.getenv("SAMSARA_API_TOKEN")
-SAMSARA_BASE_URL  = "https://api.samsara.com"
+SAMSARA_API_TOKEN = settings.samsara_api_token
+SAMSARA_BASE_URL  = settings.samsara_base_url
 
 # -- Telegram -----------------------------------------------------------------
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
-TELEGRAM_GROUP_ID  = os.getenv("TELEGRAM_GROUP_ID", "").strip()
+TELEGRAM_BOT_TOKEN = settings.telegram_bot_token
+TELEGRAM_GROUP_ID  = settings.telegram_group_id
 
 # -- SQLite -------------------------------------------------------------------
-# Set DATA_DIR to a Railway persistent volume path e.g. /data
-# Defaults to current directory for local development
-DATA_DIR = os.getenv("DATA_DIR", ".")
+DATA_DIR = settings.data_dir
 
 # -- Fuel threshold -----------------------------------------------------------
-FUEL_ALERT_THRESHOLD_PCT = float(os.getenv("FUEL_ALERT_THRESHOLD_PCT", 30))
+FUEL_ALERT_THRESHOLD_PCT = settings.fuel_alert_threshold_pct
 
 # -- Stop search radii --------------------------------------------------------
-PILOT_RADIUS_MILES    = float(os.getenv("PILOT_RADIUS_MILES",    50))
-LOVES_RADIUS_MILES    = float(os.getenv("LOVES_RADIUS_MILES",    50))
-EXTENDED_RADIUS_MILES = float(os.getenv("EXTENDED_RADIUS_MILES", 80))
+PILOT_RADIUS_MILES    = settings.pilot_radius_miles
+LOVES_RADIUS_MILES    = settings.loves_radius_miles
+EXTENDED_RADIUS_MILES = settings.extended_radius_miles
 
 # -- Polling intervals (minutes) ----------------------------------------------
-POLL_INTERVAL_HEALTHY         = int(os.getenv("POLL_INTERVAL_HEALTHY",         60))
-POLL_INTERVAL_WATCH           = int(os.getenv("POLL_INTERVAL_WATCH",           20))
-POLL_INTERVAL_CRITICAL_MOVING = int(os.getenv("POLL_INTERVAL_CRITICAL_MOVING", 10))
-POLL_INTERVAL_CRITICAL_PARKED = int(os.getenv("POLL_INTERVAL_CRITICAL_PARKED", 60))
+POLL_INTERVAL_HEALTHY         = settings.poll_interval_healthy
+POLL_INTERVAL_WATCH           = settings.poll_interval_watch
+POLL_INTERVAL_CRITICAL_MOVING = settings.poll_interval_critical_moving
+POLL_INTERVAL_CRITICAL_PARKED = settings.poll_interval_critical_parked
 
 # -- Yard geofences -----------------------------------------------------------
-# Format in .env:  YARD_N=Yard Name:latitude:longitude:radius_miles
-# Example:         YARD_1=Main Yard:28.4277:-81.3816:0.5
-YARDS = []
-for _i in range(1, 20):
-    _val = os.getenv(f"YARD_{_i}", "").strip()
-    if not _val:
-        continue
-    _parts = _val.split(":")
-    if len(_parts) != 4:
-        continue
-    try:
-        YARDS.append({
-            "name":         _parts[0].strip(),
-            "lat":          float(_parts[1]),
-            "lng":          float(_parts[2]),
-            "radius_miles": float(_parts[3]),
-        })
-    except ValueError:
-        pass
+YARDS = list(settings.yards)
 
 # -- Skip / visit detection ---------------------------------------------------
-SKIP_DETECTION_HOURS = int(os.getenv("SKIP_DETECTION_HOURS", 10))
-VISIT_RADIUS_MILES   = float(os.getenv("VISIT_RADIUS_MILES", 0.5))
+SKIP_DETECTION_HOURS = settings.skip_detection_hours
+VISIT_RADIUS_MILES   = settings.visit_radius_miles
 
 # -- State persistence --------------------------------------------------------
-STATE_SAVE_INTERVAL_SECONDS = int(os.getenv("STATE_SAVE_INTERVAL_SECONDS", 300))
+STATE_SAVE_INTERVAL_SECONDS = settings.state_save_interval_seconds
+
+# -- Concurrency --------------------------------------------------------------
+PROCESS_WORKERS = settings.process_workers
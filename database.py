@@ -14,11 +14,18 @@ Tables:
 """
 
 import sqlite3
+import json
+import math
 import os
-from config import DATA_DIR
+import threading
+import atexit
+import time
+from config import DATA_DIR, STATE_SAVE_INTERVAL_SECONDS
 import logging
 from contextlib import contextmanager
-from datetime import datetime
+from functools import lru_cache
+from datetime import datetime, timezone
+from urllib.parse import quote
 
 log = logging.getLogger(__name__)
 
@@ -26,33 +33,162 @@ log = logging.getLogger(__name__)
 
 DB_PATH  = os.path.join(DATA_DIR, "fleet.db")
 
+# One long-lived connection per process. SQLite allows a single writer, so
+# every helper shares this handle and _LOCK serializes access to it.
+_CONN = None
+_LOCK = threading.Lock()
+
+# Separate read-only connection for the read helpers. Under WAL a reader never
+# blocks the writer, so lookups don't queue behind a state flush on _LOCK.
+_RO_CONN = None
+_RO_LOCK = threading.Lock()
+
+# Prepared-statement cache on the shared connection; holds every _SQL_* below
+_STATEMENT_CACHE_SIZE = 256
+
+# Built once at import; get_connection() only unpacks them
+_CONNECT_KWARGS = dict(
+    check_same_thread=False,
+    detect_types=sqlite3.PARSE_COLNAMES,
+    cached_statements=_STATEMENT_CACHE_SIZE,
+)
+
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA foreign_keys=ON",
+    # WAL + NORMAL syncs at checkpoints instead of on every commit
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",       # ~20 MB page cache
+    "PRAGMA mmap_size=268435456",     # 256 MB memory-mapped reads
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+_READ_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+)
+
 
 def get_connection():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row   # rows behave like dicts
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
+    """Return the shared connection, opening it on first use."""
+    global _CONN
+    if _CONN is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, **_CONNECT_KWARGS)
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        _ensure_math_functions(conn)
+        _CONN = conn
+    return _CONN
+
+
+def get_read_connection():
+    """Return the shared read-only connection, opening it on first use."""
+    global _RO_CONN
+    if _RO_CONN is None:
+        with _LOCK:
+            get_connection()   # creates the file and switches it to WAL
+        conn = sqlite3.connect(f"file:{quote(DB_PATH)}?mode=ro", uri=True, **_CONNECT_KWARGS)
+        for pragma in _READ_PRAGMAS:
+            conn.execute(pragma)
+        _ensure_math_functions(conn)
+        _RO_CONN = conn
+    return _RO_CONN
+
+
+def optimize_db():
+    """Refresh planner statistics so the partial/geo indexes keep being chosen."""
+    with _LOCK:
+        if _CONN is not None:
+            _CONN.execute("PRAGMA optimize")
+
+
+@atexit.register
+def close_db():
+    """Optimize, truncate the WAL, and close the shared connection at exit."""
+    global _CONN, _RO_CONN
+    with _RO_LOCK:
+        if _RO_CONN is not None:
+            _RO_CONN.close()
+            _RO_CONN = None
+    with _LOCK:
+        if _CONN is None:
+            return
+        try:
+            _CONN.execute("PRAGMA optimize")
+            _CONN.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            log.warning("SQLite close-time maintenance failed: %s", e)
+        _CONN.close()
+        _CONN = None
+
+
+def _ensure_math_functions(conn):
+    """
+    Distance queries use SQLite's built-in math functions (3.35+, when compiled
+    with SQLITE_ENABLE_MATH_FUNCTIONS). Register Python equivalents if missing.
+    """
+    try:
+        conn.execute("SELECT asin(sqrt(pow(sin(radians(0)), 2) + cos(0)))")
+        return
+    except sqlite3.OperationalError:
+        pass
+    log.info("SQLite math functions unavailable - registering Python fallbacks")
+    for name, nargs, fn in (
+        ("radians", 1, math.radians),
+        ("sin",     1, math.sin),
+        ("cos",     1, math.cos),
+        ("asin",    1, math.asin),
+        ("sqrt",    1, math.sqrt),
+        ("pow",     2, math.pow),
+    ):
+        conn.create_function(name, nargs, fn, deterministic=True)
 
 
 @contextmanager
-def db_cursor():
-    """Yields a cursor; commits on success, rolls back on error."""
-    conn = get_connection()
-    try:
+def db_cursor(row_factory=None):
+    """
+    Yields a cursor; commits on success, rolls back on error.
+    Rows are plain tuples unless a row_factory (e.g. sqlite3.Row) is given;
+    writers and the _fetch_dicts() bulk readers don't need one.
+    """
+    with _LOCK:
+        conn = get_connection()
         cur = conn.cursor()
-        yield cur
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+        cur.row_factory = row_factory
+        try:
+            yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+@contextmanager
+def db_read_cursor(row_factory=None):
+    """Yields a cursor on the read-only connection; for SELECTs only."""
+    with _RO_LOCK:
+        cur = get_read_connection().cursor()
+        cur.row_factory = row_factory
+        try:
+            yield cur
+        finally:
+            cur.close()
 
 
 # -- Schema -------------------------------------------------------------------
 
+# Bump whenever SCHEMA_SQL changes; init_db() skips the script when the file's
+# PRAGMA user_version already matches.
+SCHEMA_VERSION = 1
+
+# Set once init_db() has run in this process; main and the seeder both call it
+_SCHEMA_READY = False
+
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS pilot_stops (
     id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,7 +205,36 @@ CREATE TABLE IF NOT EXISTS pilot_stops (
     created_at  TEXT    NOT NULL DEFAULT (datetime('now'))
 );
 
-CREATE INDEX IF NOT EXISTS idx_pilot_stops_lat_lng ON pilot_stops (latitude, longitude);
+-- Natural key: one row per (name, position), so re-seeding updates in place
+CREATE UNIQUE INDEX IF NOT EXISTS idx_pilot_stops_natural ON pilot_stops (name, latitude, longitude);
+
+-- R*Tree over diesel stops, used by the radius searches. Each stop is a
+-- zero-size box; triggers keep it in step with pilot_stops.
+DROP INDEX IF EXISTS idx_pilot_stops_lat_lng;
+CREATE VIRTUAL TABLE IF NOT EXISTS pilot_stops_rtree USING rtree (
+    id, min_lat, max_lat, min_lng, max_lng
+);
+
+CREATE TRIGGER IF NOT EXISTS pilot_stops_rtree_ins AFTER INSERT ON pilot_stops
+WHEN new.has_diesel = 1 BEGIN
+    INSERT OR REPLACE INTO pilot_stops_rtree
+        VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+END;
+
+CREATE TRIGGER IF NOT EXISTS pilot_stops_rtree_upd
+AFTER UPDATE OF latitude, longitude, has_diesel ON pilot_stops BEGIN
+    DELETE FROM pilot_stops_rtree WHERE id = old.id;
+    INSERT INTO pilot_stops_rtree
+        SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE new.has_diesel = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS pilot_stops_rtree_del AFTER DELETE ON pilot_stops BEGIN
+    DELETE FROM pilot_stops_rtree WHERE id = old.id;
+END;
+
+INSERT OR REPLACE INTO pilot_stops_rtree
+    SELECT id, latitude, latitude, longitude, longitude FROM pilot_stops WHERE has_diesel = 1;
 
 CREATE TABLE IF NOT EXISTS fuel_alerts (
     id              INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -111,7 +276,13 @@ CREATE TABLE IF NOT EXISTS stop_flags (
     FOREIGN KEY (stop_id)  REFERENCES pilot_stops(id)
 );
 
-CREATE INDEX IF NOT EXISTS idx_stop_flags_vehicle ON stop_flags (vehicle_id, flag);
+-- Pending flags only. Covers every stop_flags column the per-vehicle
+-- pending-flag queries project (flag included), so those reads never touch
+-- the table rows, and it is in flagged_at order, so no temp sort either.
+DROP INDEX IF EXISTS idx_stop_flags_vehicle;
+CREATE INDEX IF NOT EXISTS idx_stop_flags_pending_vehicle
+    ON stop_flags (vehicle_id, flagged_at, alert_id, stop_id, flag)
+    WHERE flag = 'pending';
 
 CREATE TABLE IF NOT EXISTS truck_states (
     vehicle_id              TEXT PRIMARY KEY,
@@ -142,309 +313,606 @@ CREATE TABLE IF NOT EXISTS truck_states (
 """
 
 
+# Databases seeded before idx_pilot_stops_natural existed hold duplicate stops
+# (the old ON CONFLICT(rowid) never fired). Repoint references at the oldest
+# copy of each stop and drop the rest so the unique index can be built.
+_DEDUPE_STOPS_SQL = """
+CREATE TEMP TABLE _stop_keep AS
+    SELECT p.id AS id, k.keep_id AS keep_id
+    FROM pilot_stops p
+    JOIN (SELECT MIN(id) AS keep_id, name, latitude, longitude
+          FROM pilot_stops GROUP BY name, latitude, longitude) k
+      ON p.name = k.name AND p.latitude = k.latitude AND p.longitude = k.longitude
+    WHERE p.id <> k.keep_id;
+
+UPDATE stop_assignments SET stop_id = (SELECT keep_id FROM _stop_keep WHERE id = stop_id)
+    WHERE stop_id IN (SELECT id FROM _stop_keep);
+UPDATE stop_flags SET stop_id = (SELECT keep_id FROM _stop_keep WHERE id = stop_id)
+    WHERE stop_id IN (SELECT id FROM _stop_keep);
+UPDATE truck_states SET assigned_stop_id = (SELECT keep_id FROM _stop_keep WHERE id = assigned_stop_id)
+    WHERE assigned_stop_id IN (SELECT id FROM _stop_keep);
+DELETE FROM pilot_stops WHERE id IN (SELECT id FROM _stop_keep);
+
+DROP TABLE _stop_keep;
+"""
+
+
+def _needs_stop_dedupe(conn) -> bool:
+    """True on databases whose pilot_stops predates the natural key."""
+    has_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='pilot_stops'"
+    ).fetchone()
+    has_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_pilot_stops_natural'"
+    ).fetchone()
+    return bool(has_table and not has_index)
+
+
 def init_db():
-    """Create all tables if they don't exist."""
-    log.info(f"Using database: {DB_PATH}")
-    conn = get_connection()
-    conn.executescript(SCHEMA_SQL)
-    conn.commit()
-    conn.close()
-    print("✅  Database schema ready.")
+    """
+    Create all tables if they don't exist.
+    Dedupe, schema and user_version go through as one script in a single
+    transaction, so a failed upgrade leaves the previous schema intact.
+    """
+    global _SCHEMA_READY
+    if _SCHEMA_READY:
+        return
+    log.info("Using database: %s", DB_PATH)
+    with _LOCK:
+        conn = get_connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            _SCHEMA_READY = True
+            log.info("✅  Database schema ready (v%d).", version)
+            return
+        script = ["BEGIN;"]
+        if _needs_stop_dedupe(conn):
+            log.info("Removing duplicate pilot_stops rows before adding unique key...")
+            script.append(_DEDUPE_STOPS_SQL)
+        script.append(SCHEMA_SQL)
+        script.append(f"PRAGMA user_version = {SCHEMA_VERSION};\nCOMMIT;")
+        try:
+            conn.executescript("\n".join(script))
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        _SCHEMA_READY = True
+    log.info("✅  Database schema ready.")
 
 
 # -- Helpers ------------------------------------------------------------------
 
 def _row_to_dict(row):
-    """Convert sqlite3.Row to plain dict."""
+    """Convert sqlite3.Row (from db_cursor(sqlite3.Row)) to plain dict."""
     if row is None:
         return None
     return dict(row)
 
 
-def _rows_to_dicts(rows):
-    return [dict(r) for r in rows]
+def _fetch_dicts(cur) -> list:
+    """
+    Fetch all rows from a tuple-row cursor as dicts.
+    Column names are read once from cur.description and zipped per row,
+    which is cheaper than going through sqlite3.Row for bulk reads.
+    """
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, r)) for r in cur.fetchall()]
 
 
-def _dt(val):
-    """Parse datetime string from SQLite back to datetime object."""
-    if val is None:
-        return None
-    if isinstance(val, datetime):
-        return val
+@lru_cache(maxsize=4096)
+def _parse_iso(val: str):
+    """Cached fromisoformat(); the same timestamps recur across loads."""
     try:
         return datetime.fromisoformat(val)
     except Exception:
         return None
 
 
-def _str_dt(val):
-    """Convert datetime to ISO string for storage."""
+def _dt(val):
+    """Parse datetime string from SQLite back to datetime object."""
     if val is None:
         return None
     if isinstance(val, datetime):
-        return val.isoformat()
-    return str(val)
+        return val
+    return _parse_iso(val)
+
+
+def _convert_isodt(raw: bytes):
+    """sqlite3 converter for columns tagged [isodt] in a query."""
+    return _dt(raw.decode())
+
+
+sqlite3.register_converter("isodt", _convert_isodt)
+
+# datetimes bind as ISO strings (same format _dt/fromisoformat reads back)
+sqlite3.register_adapter(datetime, datetime.isoformat)
 
 
 # -- pilot_stops --------------------------------------------------------------
 
-def upsert_pilot_stop(row: dict) -> int:
-    """Insert or update a stop from CSV seed. Returns stop id."""
-    sql = """
-        INSERT INTO pilot_stops
-            (name, brand, address, city, state, zip, latitude, longitude, phone, has_diesel)
-        VALUES
-            (:name, :brand, :address, :city, :state, :zip,
-             :latitude, :longitude, :phone, :has_diesel)
-        ON CONFLICT(rowid) DO UPDATE SET
-            name=excluded.name, address=excluded.address,
-            latitude=excluded.latitude, longitude=excluded.longitude
-    """
+_SQL_UPSERT_STOPS_BULK = """
+    INSERT INTO pilot_stops
+        (name, brand, address, city, state, zip, latitude, longitude, phone, has_diesel)
+    VALUES
+        (:name, :brand, :address, :city, :state, :zip,
+         :latitude, :longitude, :phone, :has_diesel)
+    ON CONFLICT(name, latitude, longitude) DO UPDATE SET
+        brand=excluded.brand, address=excluded.address,
+        city=excluded.city, state=excluded.state, zip=excluded.zip,
+        phone=excluded.phone, has_diesel=excluded.has_diesel
+"""
+
+# Columns the stop finder and alerts use (created_at is never read back)
+_STOP_COLUMNS = "id, name, brand, address, city, state, zip, latitude, longitude, phone, has_diesel"
+
+_SQL_STOPS_WITH_DIESEL = f"SELECT {_STOP_COLUMNS} FROM pilot_stops WHERE has_diesel = 1"
+
+_SQL_STOP_BY_ID = f"SELECT {_STOP_COLUMNS} FROM pilot_stops WHERE id = ?"
+
+# Box lookups go through pilot_stops_rtree, which only holds diesel stops.
+# Params are (min_lat, max_lat, min_lng, max_lng) as from _bounding_box().
+_SQL_RTREE_IN_BOX = """
+    SELECT id FROM pilot_stops_rtree
+    WHERE max_lat >= :min_lat AND min_lat <= :max_lat
+      AND max_lng >= :min_lng AND min_lng <= :max_lng
+"""
+
+_SQL_STOPS_IN_BOX = f"""
+    SELECT {_STOP_COLUMNS} FROM pilot_stops
+    WHERE id IN ({_SQL_RTREE_IN_BOX})
+"""
+
+# Haversine evaluated inside SQLite (7917.6 = Earth diameter in miles)
+_SQL_NEAREST_STOPS = f"""
+    SELECT * FROM (
+        SELECT {_STOP_COLUMNS},
+               7917.6 * asin(sqrt(min(1.0,
+                   pow(sin(radians(latitude - :lat) / 2), 2) +
+                   cos(radians(:lat)) * cos(radians(latitude)) *
+                   pow(sin(radians(longitude - :lng) / 2), 2)
+               ))) AS dist_miles
+        FROM pilot_stops
+        WHERE id IN ({_SQL_RTREE_IN_BOX})
+          AND id NOT IN (SELECT value FROM json_each(:exclude_ids))
+          AND (:brands IS NULL OR EXISTS (
+                  SELECT 1 FROM json_each(:brands) WHERE instr(lower(brand), value) > 0))
+    )
+    WHERE dist_miles <= :radius
+    ORDER BY dist_miles
+    LIMIT :k
+"""
+
+_MILES_PER_DEG_LAT = 69.0
+
+
+def upsert_pilot_stops_bulk(rows: list) -> int:
+    """Insert or update many stops in one transaction. Returns row count."""
+    if not rows:
+        return 0
     with db_cursor() as cur:
-        cur.execute(sql, row)
-        return cur.lastrowid
+        cur.executemany(_SQL_UPSERT_STOPS_BULK, rows)
+    return len(rows)
 
 
 def get_all_stops_with_diesel() -> list:
     """Return all stops that have diesel fuel."""
-    with db_cursor() as cur:
-        cur.execute("SELECT * FROM pilot_stops WHERE has_diesel = 1")
-        return _rows_to_dicts(cur.fetchall())
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_STOPS_WITH_DIESEL)
+        return _fetch_dicts(cur)
+
+
+def _bounding_box(lat: float, lng: float, radius_miles: float) -> tuple:
+    """(min_lat, max_lat, min_lng, max_lng) enclosing a circle of radius_miles."""
+    dlat = radius_miles / _MILES_PER_DEG_LAT
+    # Clamp cos() so the box stays finite near the poles
+    dlng = radius_miles / (_MILES_PER_DEG_LAT * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+def get_stops_near(lat: float, lng: float, radius_miles: float) -> list:
+    """
+    Return diesel stops inside the bounding box around (lat, lng), found via
+    the pilot_stops_rtree R*Tree. The box is a superset of the radius circle;
+    callers still apply the exact distance check, but only to stops in the box
+    rather than the whole table.
+    """
+    min_lat, max_lat, min_lng, max_lng = _bounding_box(lat, lng, radius_miles)
+    params = {
+        "min_lat": min_lat, "max_lat": max_lat,
+        "min_lng": min_lng, "max_lng": max_lng,
+    }
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_STOPS_IN_BOX, params)
+        return _fetch_dicts(cur)
+
+
+def get_nearest_stops(lat: float, lng: float, radius_miles: float, k: int,
+                      exclude_ids=(), brands=None) -> list:
+    """
+    Return up to k diesel stops within radius_miles, nearest first.
+    Distance is computed in SQL and returned as dist_miles. Stops in
+    exclude_ids are skipped and, if brands is given, only stops whose
+    lower-cased brand contains one of those substrings count, both before
+    the LIMIT, so filtered-out rows never crowd out a match further away.
+    """
+    min_lat, max_lat, min_lng, max_lng = _bounding_box(lat, lng, radius_miles)
+    params = {
+        "lat": lat, "lng": lng, "radius": radius_miles, "k": k,
+        "exclude_ids": json.dumps(list(exclude_ids)),
+        "brands": json.dumps(list(brands)) if brands is not None else None,
+        "min_lat": min_lat, "max_lat": max_lat,
+        "min_lng": min_lng, "max_lng": max_lng,
+    }
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_NEAREST_STOPS, params)
+        return _fetch_dicts(cur)
 
 
 def get_stop_by_id(stop_id: int) -> dict | None:
     """Get stop details by ID."""
-    with db_cursor() as cur:
-        cur.execute("SELECT * FROM pilot_stops WHERE id = ?", (stop_id,))
+    with db_read_cursor(sqlite3.Row) as cur:
+        cur.execute(_SQL_STOP_BY_ID, (stop_id,))
         return _row_to_dict(cur.fetchone())
 
 
 # -- fuel_alerts --------------------------------------------------------------
 
+_SQL_CREATE_ALERT = """
+    INSERT INTO fuel_alerts
+        (vehicle_id, vehicle_name, driver_name, fuel_pct,
+         latitude, longitude, heading, speed_mph)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_SET_ALERT_MSG = "UPDATE fuel_alerts SET telegram_msg_id=? WHERE id=?"
+
+_SQL_RESOLVE_ALERT = "UPDATE fuel_alerts SET status='resolved' WHERE id=?"
+
+_SQL_SKIP_ALERT = "UPDATE fuel_alerts SET status='skipped' WHERE id=?"
+
+_SQL_OPEN_ALERT_FOR_VEHICLE = """
+    SELECT * FROM fuel_alerts
+    WHERE vehicle_id=? AND status='open'
+    ORDER BY alert_sent_at DESC LIMIT 1
+"""
+
+
 def create_fuel_alert(vehicle_id, vehicle_name, driver_name,
                       fuel_pct, lat, lng, heading, speed_mph) -> int:
-    sql = """
-        INSERT INTO fuel_alerts
-            (vehicle_id, vehicle_name, driver_name, fuel_pct,
-             latitude, longitude, heading, speed_mph)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """
     with db_cursor() as cur:
-        cur.execute(sql, (vehicle_id, vehicle_name, driver_name,
-                          fuel_pct, lat, lng, heading, speed_mph))
+        cur.execute(_SQL_CREATE_ALERT, (vehicle_id, vehicle_name, driver_name,
+                                        fuel_pct, lat, lng, heading, speed_mph))
         return cur.lastrowid
 
 
 def update_alert_telegram_msg(alert_id: int, msg_id: int):
     with db_cursor() as cur:
-        cur.execute(
-            "UPDATE fuel_alerts SET telegram_msg_id=? WHERE id=?",
-            (msg_id, alert_id)
-        )
+        cur.execute(_SQL_SET_ALERT_MSG, (msg_id, alert_id))
 
 
 def resolve_alert(alert_id: int):
     with db_cursor() as cur:
-        cur.execute(
-            "UPDATE fuel_alerts SET status='resolved' WHERE id=?",
-            (alert_id,)
-        )
+        cur.execute(_SQL_RESOLVE_ALERT, (alert_id,))
 
 
 def mark_alert_skipped(alert_id: int):
     with db_cursor() as cur:
-        cur.execute(
-            "UPDATE fuel_alerts SET status='skipped' WHERE id=?",
-            (alert_id,)
-        )
+        cur.execute(_SQL_SKIP_ALERT, (alert_id,))
 
 
 # -- stop_assignments ---------------------------------------------------------
 
-def create_stop_assignment(alert_id: int, stop_id: int, distance_miles: float) -> int:
-    with db_cursor() as cur:
-        cur.execute(
-            "INSERT INTO stop_assignments (alert_id, stop_id, distance_miles) VALUES (?, ?, ?)",
-            (alert_id, stop_id, distance_miles)
-        )
-        return cur.lastrowid
+_SQL_CREATE_ASSIGNMENT = (
+    "INSERT INTO stop_assignments (alert_id, stop_id, distance_miles) VALUES (?, ?, ?)"
+)
 
 
 # -- stop_flags ---------------------------------------------------------------
 
-def create_pending_flag(alert_id: int, vehicle_id: str, stop_id: int) -> int:
-    with db_cursor() as cur:
-        cur.execute(
-            "INSERT INTO stop_flags (alert_id, vehicle_id, stop_id, flag) VALUES (?, ?, ?, 'pending')",
-            (alert_id, vehicle_id, stop_id)
-        )
-        return cur.lastrowid
+_SQL_CREATE_PENDING_FLAG = (
+    "INSERT INTO stop_flags (alert_id, vehicle_id, stop_id, flag) VALUES (?, ?, ?, 'pending')"
+)
+
+_SQL_FLAG_VISITED = (
+    "UPDATE stop_flags SET flag='visited', flagged_at=datetime('now') WHERE id=?"
+)
+
+_SQL_FLAG_SKIPPED = (
+    "UPDATE stop_flags SET flag='skipped', flagged_at=datetime('now'), skip_alert_msg_id=? WHERE id=?"
+)
+
+_SQL_PENDING_FLAGS_FOR_VEHICLE = """
+    SELECT sf.id, sf.alert_id, sf.vehicle_id, sf.stop_id, sf.flag, sf.flagged_at,
+           ps.name AS stop_name,
+           ps.latitude AS stop_lat, ps.longitude AS stop_lng,
+           fa.telegram_msg_id
+    FROM stop_flags sf
+    JOIN pilot_stops ps ON sf.stop_id = ps.id
+    JOIN fuel_alerts fa ON sf.alert_id = fa.id
+    WHERE sf.vehicle_id=? AND sf.flag='pending'
+    ORDER BY sf.flagged_at ASC
+"""
+
+# Same rows for the whole fleet; walks idx_stop_flags_pending_vehicle in order
+_SQL_ALL_PENDING_FLAGS = """
+    SELECT sf.id, sf.alert_id, sf.vehicle_id, sf.stop_id, sf.flag, sf.flagged_at,
+           ps.name AS stop_name,
+           ps.latitude AS stop_lat, ps.longitude AS stop_lng,
+           fa.telegram_msg_id
+    FROM stop_flags sf
+    JOIN pilot_stops ps ON sf.stop_id = ps.id
+    JOIN fuel_alerts fa ON sf.alert_id = fa.id
+    WHERE sf.flag='pending'
+    ORDER BY sf.vehicle_id, sf.flagged_at ASC
+"""
 
 
 def mark_flag_visited(flag_id: int):
     with db_cursor() as cur:
-        cur.execute(
-            "UPDATE stop_flags SET flag='visited', flagged_at=datetime('now') WHERE id=?",
-            (flag_id,)
-        )
+        cur.execute(_SQL_FLAG_VISITED, (flag_id,))
 
 
 def mark_flag_skipped(flag_id: int, skip_msg_id: int = None):
     with db_cursor() as cur:
-        cur.execute(
-            "UPDATE stop_flags SET flag='skipped', flagged_at=datetime('now'), skip_alert_msg_id=? WHERE id=?",
-            (skip_msg_id, flag_id)
-        )
+        cur.execute(_SQL_FLAG_SKIPPED, (skip_msg_id, flag_id))
 
 
-def get_pending_flag_by_alert(alert_id: int) -> dict | None:
-    with db_cursor() as cur:
-        cur.execute(
-            """SELECT sf.*, ps.name AS stop_name,
-                      ps.latitude AS stop_lat, ps.longitude AS stop_lng
-               FROM stop_flags sf
-               JOIN pilot_stops ps ON sf.stop_id = ps.id
-               WHERE sf.alert_id=? AND sf.flag='pending'
-               LIMIT 1""",
-            (alert_id,)
-        )
-        return _row_to_dict(cur.fetchone())
+def get_pending_flags_for_vehicle(vehicle_id: str) -> list:
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_PENDING_FLAGS_FOR_VEHICLE, (vehicle_id,))
+        return _fetch_dicts(cur)
 
 
-def get_pending_flags_for_vehicle(vehicle_id: str) -> list:
+def get_pending_flags_by_vehicle() -> dict:
+    """
+    All pending flags in one query: {vehicle_id: [flag, ...]}, each list in
+    flagged_at order. Lets a poll cycle prefetch instead of querying per truck.
+    """
+    by_vehicle = {}
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_ALL_PENDING_FLAGS)
+        for flag in _fetch_dicts(cur):
+            by_vehicle.setdefault(flag["vehicle_id"], []).append(flag)
+    return by_vehicle
+
+
+# -- Alert events -------------------------------------------------------------
+
+def create_full_alert(vehicle_id, vehicle_name, driver_name, fuel_pct,
+                      lat, lng, heading, speed_mph,
+                      stop_id: int, distance_miles: float) -> tuple:
+    """
+    Insert the alert, its stop assignment and the pending flag in one
+    transaction. Returns (alert_id, assignment_id, flag_id).
+    """
     with db_cursor() as cur:
-        cur.execute(
-            """SELECT sf.*, ps.name AS stop_name,
-                      ps.latitude AS stop_lat, ps.longitude AS stop_lng,
-                      fa.telegram_msg_id
-               FROM stop_flags sf
-               JOIN pilot_stops ps ON sf.stop_id = ps.id
-               JOIN fuel_alerts fa ON sf.alert_id = fa.id
-               WHERE sf.vehicle_id=? AND sf.flag='pending'
-               ORDER BY sf.flagged_at ASC""",
-            (vehicle_id,)
-        )
-        return _rows_to_dicts(cur.fetchall())
+        cur.execute(_SQL_CREATE_ALERT, (vehicle_id, vehicle_name, driver_name,
+                                        fuel_pct, lat, lng, heading, speed_mph))
+        alert_id = cur.lastrowid
+        cur.execute(_SQL_CREATE_ASSIGNMENT, (alert_id, stop_id, distance_miles))
+        assignment_id = cur.lastrowid
+        cur.execute(_SQL_CREATE_PENDING_FLAG, (alert_id, vehicle_id, stop_id))
+        return alert_id, assignment_id, cur.lastrowid
 
 
 # -- truck_states -------------------------------------------------------------
 
-def load_all_truck_states() -> dict:
-    """Load all truck states from DB. Returns {vehicle_id: state_dict}"""
-    with db_cursor() as cur:
-        cur.execute("SELECT * FROM truck_states")
-        rows = cur.fetchall()
+# Column aliases do the latitude->lat / longitude->lng rename inside SQLite,
+# and the [isodt] tags make sqlite3 hand back datetime objects directly.
+_SQL_ALL_STATES = """
+    SELECT vehicle_id, vehicle_name, driver_name, state, fuel_pct,
+           latitude  AS lat,
+           longitude AS lng,
+           speed_mph, heading,
+           next_poll       AS "next_poll [isodt]",
+           parked_since    AS "parked_since [isodt]",
+           alert_sent, overnight_alert_sent, open_alert_id,
+           assigned_stop_id, assigned_stop_name,
+           assigned_stop_lat, assigned_stop_lng,
+           assignment_time AS "assignment_time [isodt]",
+           in_yard, yard_name, sleeping, fuel_when_parked
+    FROM truck_states
+"""
+
+_SQL_RESET_STATES = "DELETE FROM truck_states"
 
+
+# In-memory truck states are authoritative while the bot runs. save_truck_state()
+# snapshots a truck's bind params and queues them; the writer thread flushes the
+# queue to SQLite every STATE_SAVE_INTERVAL_SECONDS. Changes to the alert
+# fields are flushed at once, so a crash can't lose an alert that was already
+# recorded and sent (and fire it again on restart).
+_STATE_CACHE: dict[str, dict] = {}
+_PENDING_STATES: dict[str, tuple] = {}   # vid -> params waiting for a flush
+# Bind params last written (or being written) per vehicle; unchanged saves skip
+_LAST_SAVED: dict[str, tuple] = {}
+_STATE_LOCK = threading.Lock()           # guards the three dicts above
+_FLUSH_LOCK = threading.Lock()           # one flush at a time, in queue order
+_writer_stop = threading.Event()
+_writer_thread = None
+
+
+def load_all_truck_states() -> dict:
+    """
+    Load all truck states from DB. Returns {vehicle_id: state_dict}
+    Flag columns come back as 0/1 ints, which the state machine treats as bools.
+    next_poll is normalised to tz-aware UTC here, once, so the poll scheduler
+    never has to check it. The returned dict is the module's state cache itself.
+    """
+    # Iterate the cursor rather than fetchall(): one row tuple in flight at a time
     states = {}
-    for row in rows:
-        r = dict(row)
-        vid = r["vehicle_id"]
-        states[vid] = {
-            "vehicle_id":           vid,
-            "vehicle_name":         r["vehicle_name"],
-            "driver_name":          r["driver_name"],
-            "state":                r["state"],
-            "fuel_pct":             r["fuel_pct"],
-            "lat":                  r["latitude"],
-            "lng":                  r["longitude"],
-            "speed_mph":            r["speed_mph"],
-            "heading":              r["heading"],
-            "next_poll":            _dt(r["next_poll"]),
-            "parked_since":         _dt(r["parked_since"]),
-            "alert_sent":           bool(r["alert_sent"]),
-            "overnight_alert_sent": bool(r["overnight_alert_sent"]),
-            "open_alert_id":        r["open_alert_id"],
-            "assigned_stop_id":     r["assigned_stop_id"],
-            "assigned_stop_name":   r["assigned_stop_name"],
-            "assigned_stop_lat":    r["assigned_stop_lat"],
-            "assigned_stop_lng":    r["assigned_stop_lng"],
-            "assignment_time":      _dt(r["assignment_time"]),
-            "in_yard":              bool(r["in_yard"]),
-            "yard_name":            r["yard_name"],
-            "sleeping":             bool(r.get("sleeping", 0)),
-            "fuel_when_parked":     r.get("fuel_when_parked"),
-        }
-    return states
+    with db_read_cursor() as cur:
+        cur.execute(_SQL_ALL_STATES)
+        cols = [d[0] for d in cur.description]
+        for row in cur:
+            state = dict(zip(cols, row))
+            next_poll = state["next_poll"]
+            if next_poll is not None and next_poll.tzinfo is None:
+                state["next_poll"] = next_poll.replace(tzinfo=timezone.utc)
+            states[row[0]] = state
+    with _STATE_LOCK:
+        _STATE_CACHE.clear()
+        _STATE_CACHE.update(states)
+        _PENDING_STATES.clear()
+        _LAST_SAVED.clear()
+        _LAST_SAVED.update((vid, _state_params(s)) for vid, s in states.items())
+    return _STATE_CACHE
+
+
+_SQL_UPSERT_STATE = """
+    INSERT INTO truck_states
+        (vehicle_id, vehicle_name, driver_name, state, fuel_pct,
+         latitude, longitude, speed_mph, heading, next_poll, parked_since,
+         alert_sent, overnight_alert_sent, open_alert_id,
+         assigned_stop_id, assigned_stop_name, assigned_stop_lat, assigned_stop_lng,
+         assignment_time, in_yard, yard_name, sleeping, fuel_when_parked,
+         last_updated)
+    VALUES
+        (?, ?, ?, ?, ?,
+         ?, ?, ?, ?, ?, ?,
+         ?, ?, ?,
+         ?, ?, ?, ?,
+         ?, ?, ?, ?, ?,
+         datetime('now'))
+    ON CONFLICT(vehicle_id) DO UPDATE SET
+        vehicle_name=excluded.vehicle_name,
+        driver_name=excluded.driver_name,
+        state=excluded.state,
+        fuel_pct=excluded.fuel_pct,
+        latitude=excluded.latitude,
+        longitude=excluded.longitude,
+        speed_mph=excluded.speed_mph,
+        heading=excluded.heading,
+        next_poll=excluded.next_poll,
+        parked_since=excluded.parked_since,
+        alert_sent=excluded.alert_sent,
+        overnight_alert_sent=excluded.overnight_alert_sent,
+        open_alert_id=excluded.open_alert_id,
+        assigned_stop_id=excluded.assigned_stop_id,
+        assigned_stop_name=excluded.assigned_stop_name,
+        assigned_stop_lat=excluded.assigned_stop_lat,
+        assigned_stop_lng=excluded.assigned_stop_lng,
+        assignment_time=excluded.assignment_time,
+        in_yard=excluded.in_yard,
+        yard_name=excluded.yard_name,
+        sleeping=excluded.sleeping,
+        fuel_when_parked=excluded.fuel_when_parked,
+        last_updated=datetime('now')
+"""
+
+
+def _state_params(state: dict) -> tuple:
+    """Bind parameters for _SQL_UPSERT_STATE, in column order."""
+    return (
+        state["vehicle_id"], state["vehicle_name"], state["driver_name"],
+        state["state"], state["fuel_pct"],
+        state["lat"], state["lng"], state["speed_mph"], state["heading"],
+        state["next_poll"], state.get("parked_since"),
+        int(state["alert_sent"]), int(state["overnight_alert_sent"]),
+        state["open_alert_id"],
+        state["assigned_stop_id"], state["assigned_stop_name"],
+        state["assigned_stop_lat"], state["assigned_stop_lng"],
+        state.get("assignment_time"),
+        int(state["in_yard"]), state["yard_name"],
+        int(state.get("sleeping", False)),
+        state.get("fuel_when_parked"),
+    )
+
+
+# _state_params() positions of state, alert_sent, overnight_alert_sent, open_alert_id
+_ALERT_PARAM_IDX = (3, 11, 12, 13)
 
 
 def save_truck_state(state: dict):
-    """Upsert a single truck state to DB."""
-    sql = """
-        INSERT INTO truck_states
-            (vehicle_id, vehicle_name, driver_name, state, fuel_pct,
-             latitude, longitude, speed_mph, heading, next_poll, parked_since,
-             alert_sent, overnight_alert_sent, open_alert_id,
-             assigned_stop_id, assigned_stop_name, assigned_stop_lat, assigned_stop_lng,
-             assignment_time, in_yard, yard_name, sleeping, fuel_when_parked,
-             last_updated)
-        VALUES
-            (?, ?, ?, ?, ?,
-             ?, ?, ?, ?, ?, ?,
-             ?, ?, ?,
-             ?, ?, ?, ?,
-             ?, ?, ?, ?, ?,
-             datetime('now'))
-        ON CONFLICT(vehicle_id) DO UPDATE SET
-            vehicle_name=excluded.vehicle_name,
-            driver_name=excluded.driver_name,
-            state=excluded.state,
-            fuel_pct=excluded.fuel_pct,
-            latitude=excluded.latitude,
-            longitude=excluded.longitude,
-            speed_mph=excluded.speed_mph,
-            heading=excluded.heading,
-            next_poll=excluded.next_poll,
-            parked_since=excluded.parked_since,
-            alert_sent=excluded.alert_sent,
-            overnight_alert_sent=excluded.overnight_alert_sent,
-            open_alert_id=excluded.open_alert_id,
-            assigned_stop_id=excluded.assigned_stop_id,
-            assigned_stop_name=excluded.assigned_stop_name,
-            assigned_stop_lat=excluded.assigned_stop_lat,
-            assigned_stop_lng=excluded.assigned_stop_lng,
-            assignment_time=excluded.assignment_time,
-            in_yard=excluded.in_yard,
-            yard_name=excluded.yard_name,
-            sleeping=excluded.sleeping,
-            fuel_when_parked=excluded.fuel_when_parked,
-            last_updated=datetime('now')
     """
-    with db_cursor() as cur:
-        cur.execute(sql, (
-            state["vehicle_id"], state["vehicle_name"], state["driver_name"],
-            state["state"], state["fuel_pct"],
-            state["lat"], state["lng"], state["speed_mph"], state["heading"],
-            _str_dt(state["next_poll"]), _str_dt(state.get("parked_since")),
-            int(state["alert_sent"]), int(state["overnight_alert_sent"]),
-            state["open_alert_id"],
-            state["assigned_stop_id"], state["assigned_stop_name"],
-            state["assigned_stop_lat"], state["assigned_stop_lng"],
-            _str_dt(state.get("assignment_time")),
-            int(state["in_yard"]), state["yard_name"],
-            int(state.get("sleeping", False)),
-            state.get("fuel_when_parked"),
-        ))
-
-
-def save_all_truck_states(states: dict):
-    """Batch save all truck states to DB."""
-    for state in states.values():
-        save_truck_state(state)
+    Queue a truck state for the next flush. Call from the thread that owns the
+    truck; the params are snapshotted here, so later edits to the dict don't
+    leak into the write. Alert-field changes are written immediately.
+    """
+    vid    = state["vehicle_id"]
+    params = _state_params(state)
+    with _STATE_LOCK:
+        _STATE_CACHE[vid] = state
+        prev = _LAST_SAVED.get(vid)
+        if params == prev:
+            _PENDING_STATES.pop(vid, None)
+            return
+        _PENDING_STATES[vid] = params
+        urgent = prev is None or any(prev[i] != params[i] for i in _ALERT_PARAM_IDX)
+    if urgent:
+        flush_truck_states()
+
+
+def flush_truck_states() -> int:
+    """Write queued truck states to DB in one transaction. Returns row count."""
+    global _PENDING_STATES
+    with _FLUSH_LOCK:
+        with _STATE_LOCK:
+            batch, _PENDING_STATES = _PENDING_STATES, {}
+            _LAST_SAVED.update(batch)
+        if not batch:
+            return 0
+        try:
+            with db_cursor() as cur:
+                cur.executemany(_SQL_UPSERT_STATE, batch.values())
+        except Exception:
+            # Re-queue unless a newer snapshot arrived meanwhile; the next flush retries
+            with _STATE_LOCK:
+                for vid, params in batch.items():
+                    _LAST_SAVED.pop(vid, None)
+                    _PENDING_STATES.setdefault(vid, params)
+            raise
+        return len(batch)
+
+
+_OPTIMIZE_INTERVAL_SECONDS = 3600
+
+
+def _state_writer_loop(interval: int):
+    last_optimize = time.monotonic()
+    while not _writer_stop.wait(interval):
+        try:
+            count = flush_truck_states()
+            if count:
+                log.info("Saved %d truck state(s)", count)
+            if time.monotonic() - last_optimize >= _OPTIMIZE_INTERVAL_SECONDS:
+                optimize_db()
+                last_optimize = time.monotonic()
+        except Exception as e:
+            log.error("Truck state flush failed: %s", e)
+
+
+def start_state_writer(interval: int = STATE_SAVE_INTERVAL_SECONDS):
+    """Start the background thread that flushes queued truck states."""
+    global _writer_thread
+    if _writer_thread and _writer_thread.is_alive():
+        return
+    _writer_stop.clear()
+    _writer_thread = threading.Thread(target=_state_writer_loop, args=(interval,),
+                                      name="state-writer", daemon=True)
+    _writer_thread.start()
+
+
+def stop_state_writer():
+    """Stop the writer thread and flush whatever is still queued."""
+    _writer_stop.set()
+    if _writer_thread:
+        _writer_thread.join(timeout=10)
+    flush_truck_states()
 
 
 def reset_truck_states():
     """Clear all truck states for a fresh start."""
     with db_cursor() as cur:
-        cur.execute("DELETE FROM truck_states")
-    print("✅  Truck states reset.")
+        cur.execute(_SQL_RESET_STATES)
+    with _STATE_LOCK:
+        _PENDING_STATES.clear()
+        _LAST_SAVED.clear()
+    log.info("✅  Truck states reset.")
 
 
 def get_open_alert_for_vehicle(vehicle_id: str) -> dict | None:
-    with db_cursor() as cur:
-        cur.execute(
-            """SELECT * FROM fuel_alerts
-               WHERE vehicle_id=? AND status='open'
-               ORDER BY alert_sent_at DESC LIMIT 1""",
-            (vehicle_id,)
-        )
+    with db_read_cursor(sqlite3.Row) as cur:
+        cur.execute(_SQL_OPEN_ALERT_FOR_VEHICLE, (vehicle_id,))
         return _row_to_dict(cur.fetchone())
@@ -1,20 +1,24 @@
 """
 main.py  -  FleetFuel Bot with smart per-truck polling
-"""
-"""
-main.py  -  FleetFuel Bot with smart per-truck polling
 Revised for Railway/Docker CSV Seeding
 """
 
+import heapq
 import logging
-import time
 import signal
+import threading
+import time
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
-from config import STATE_SAVE_INTERVAL_SECONDS
-from database import init_db, load_all_truck_states, save_all_truck_states, reset_truck_states, get_all_stops_with_diesel
+from config import PROCESS_WORKERS
+from database import (
+    init_db, load_all_truck_states, save_truck_state, reset_truck_states,
+    get_all_stops_with_diesel, get_pending_flags_by_vehicle,
+    start_state_writer, stop_state_writer,
+)
 from samsara_client import get_combined_vehicle_data
 from state_machine import process_truck
 from telegram_bot import send_startup_message
@@ -32,13 +36,20 @@ log = logging.getLogger(__name__)
 truck_states = {}
 
 # -- Graceful shutdown --------------------------------------------------------
-_running = True
+# The loop sleeps on this event, so a signal wakes it immediately
+_stop = threading.Event()
+_POLL_SLEEP_SECONDS  = 30
+_FETCH_RETRY_SECONDS = 60
+# With no truck due, Samsara is only fetched this often (new-truck discovery)
+_DISCOVERY_SECONDS   = 300
+# Never fetch more often than this, whatever the heap says
+_MIN_FETCH_SECONDS   = 10
 
 def _shutdown(signum, frame):
-    global _running
+    # Only set the event here: the handler can interrupt a DB call that holds
+    # the connection lock. State is flushed once the loop exits.
     log.info("Shutdown signal received. Saving state and stopping...")
-    save_all_truck_states(truck_states)
-    _running = False
+    _stop.set()
 
 signal.signal(signal.SIGTERM, _shutdown)
 signal.signal(signal.SIGINT,  _shutdown)
@@ -79,6 +90,14 @@ def _auto_seed():
         ("loves.csv", "loves"),
     ]
 
+    # Imported once here rather than per CSV file inside the loop; a broken
+    # seeder is logged like a failed seed and the bot starts without stops
+    try:
+        from seed_pilot_stops import seed
+    except Exception as e:
+        log.error(f"   Seed failed: could not import seed_pilot_stops: {e}", exc_info=True)
+        return
+
     seeded = False
     already_seeded = set()
 
@@ -97,7 +116,6 @@ def _auto_seed():
             already_seeded.add(real)
             log.info(f"   Seeding from {filepath} (brand={brand})...")
             try:
-                from seed_pilot_stops import seed
                 # Note: using brand_override=brand so the seeder knows which logic to use
                 seed(filepath=filepath, brand_override=brand,
                      dry_run=False, delimiter=",")
@@ -118,6 +136,102 @@ def _utcnow():
     return datetime.now(timezone.utc)
 
 
+# Full tracebacks at most once a minute per error signature (exception type +
+# message); repeats in between log one line. A Samsara or DB outage then costs
+# a handful of tracebacks instead of one per truck per cycle.
+_TRACEBACK_EVERY_SECONDS = 60
+_traceback_logged: dict[str, float] = {}
+_traceback_lock = threading.Lock()
+
+
+def _log_error(msg: str, e: Exception):
+    key = f"{type(e).__name__}: {e}"
+    now = time.monotonic()
+    with _traceback_lock:
+        full = now - _traceback_logged.get(key, float("-inf")) >= _TRACEBACK_EVERY_SECONDS
+        if full:
+            if len(_traceback_logged) >= 256:   # keep the table small
+                for k, t in list(_traceback_logged.items()):
+                    if now - t >= _TRACEBACK_EVERY_SECONDS:
+                        del _traceback_logged[k]
+            _traceback_logged[key] = now
+    log.error(f"{msg}: {key}", exc_info=e if full else None)
+
+
+# -- Poll schedule ------------------------------------------------------------
+# Min-heap of (next_poll epoch seconds, vehicle_id), so each cycle pops only
+# the trucks that are due instead of scanning every state. Entries go stale
+# when a truck is rescheduled; _pop_due() drops any whose time no longer
+# matches the truck's current next_poll.
+_poll_heap = []
+
+
+def _poll_ts(state) -> float:
+    # next_poll is always tz-aware UTC: the state machine sets it from an
+    # aware clock and load_all_truck_states() normalises older naive rows
+    next_poll = state.get("next_poll")
+    return next_poll.timestamp() if next_poll else 0.0   # None: due now
+
+
+def _schedule(vid):
+    heapq.heappush(_poll_heap, (_poll_ts(truck_states[vid]), vid))
+
+
+def _any_due(now_ts: float) -> bool:
+    """True if a truck is due; stale entries at the top are dropped on the way."""
+    while _poll_heap:
+        ts, vid = _poll_heap[0]
+        state = truck_states.get(vid)
+        if state is not None and _poll_ts(state) == ts:
+            return ts <= now_ts
+        heapq.heappop(_poll_heap)
+    return False
+
+
+def _pop_due(now_ts: float) -> list:
+    due = []
+    while _poll_heap and _poll_heap[0][0] <= now_ts:
+        ts, vid = heapq.heappop(_poll_heap)
+        state = truck_states.get(vid)
+        if state is None or vid in due or _poll_ts(state) != ts:
+            continue
+        due.append(vid)
+    return due
+
+
+def _backoff_if_still_due(vid, now):
+    """
+    A truck whose processing failed before next_poll moved forward would go
+    back on the heap at its old, past time and be retried on every wake-up.
+    Push it out by _POLL_SLEEP_SECONDS instead.
+    """
+    state = truck_states.get(vid)
+    if state is not None and _poll_ts(state) <= now.timestamp():
+        state["next_poll"] = now + timedelta(seconds=_POLL_SLEEP_SECONDS)
+
+
+def _next_sleep() -> float:
+    """
+    Seconds to wait before the next cycle: until the earliest next_poll on the
+    heap, at least 1 s, at most _POLL_SLEEP_SECONDS so new-truck discovery and
+    the Samsara refresh still run on a steady tick. A stale heap top only
+    means an early, empty wake-up.
+    """
+    if not _poll_heap:
+        return _POLL_SLEEP_SECONDS
+    until_due = _poll_heap[0][0] - _utcnow().timestamp()
+    return max(1.0, min(_POLL_SLEEP_SECONDS, until_due))
+
+
+def _process_one(vid, current_data, pending_flags):
+    try:
+        process_truck(vid, truck_states.get(vid, {}), current_data, truck_states,
+                      pending_flags)
+        save_truck_state(truck_states[vid])
+    except Exception as e:
+        _log_error(f"Error processing truck {vid}", e)
+
+
 # -- Main loop ----------------------------------------------------------------
 
 def main():
@@ -142,6 +256,8 @@ def main():
     log.info("Loading truck states from database...")
     truck_states = load_all_truck_states()
     log.info(f"   Loaded {len(truck_states)} truck states")
+    for vid in truck_states:
+        _schedule(vid)
 
     # Notify Telegram
     try:
@@ -150,67 +266,88 @@ def main():
         log.warning(f"Could not send startup message: {e}")
 
     log.info("Starting polling loop...")
+    start_state_writer()
+    # Due trucks are processed concurrently, at most PROCESS_WORKERS at once
+    pool = ThreadPoolExecutor(max_workers=PROCESS_WORKERS, thread_name_prefix="truck")
 
-    last_db_save = _utcnow()
     poll_cycle   = 0
 
-    while _running:
+    last_fetch_ts = 0.0
+    while not _stop.is_set():
         try:
-            poll_cycle += 1
             now = _utcnow()
+            now_ts = now.timestamp()
 
-            # Step 1: Find trucks due for polling
-            due_trucks = []
-            for vid, state in truck_states.items():
-                next_poll = state.get("next_poll")
-                if next_poll is None:
-                    due_trucks.append(vid)
-                elif isinstance(next_poll, datetime):
-                    if next_poll.tzinfo is None:
-                        next_poll = next_poll.replace(tzinfo=timezone.utc)
-                    if next_poll <= now:
-                        due_trucks.append(vid)
-
-            # Step 2: Fetch data from Samsara
+            # Fetched too recently, or nothing due and discovery not due
+            # either: skip the Samsara call
+            since_fetch = now_ts - last_fetch_ts
+            if since_fetch < _MIN_FETCH_SECONDS:
+                _stop.wait(max(_next_sleep(), _MIN_FETCH_SECONDS - since_fetch))
+                continue
+            if not _any_due(now_ts) and since_fetch < _DISCOVERY_SECONDS:
+                _stop.wait(_next_sleep())
+                continue
+            poll_cycle += 1
+
+            # Step 1: Fetch data from Samsara
             try:
                 all_trucks = get_combined_vehicle_data()
             except Exception as e:
                 log.error(f"Failed to fetch Samsara data: {e}")
-                time.sleep(60)
+                _stop.wait(_FETCH_RETRY_SECONDS)
                 continue
+            last_fetch_ts = now_ts
+
+            # Step 2: Pop trucks due for polling
+            due_trucks = _pop_due(now_ts)
 
             log.info(f"Poll #{poll_cycle}: {len(all_trucks)} trucks fetched, "
                      f"{len(due_trucks)} due for check")
 
-            # Step 3: Process due trucks
-            for vid in due_trucks:
-                current_data = next((t for t in all_trucks if t["vehicle_id"] == vid), None)
-                if current_data is None:
-                    if vid in truck_states:
-                        truck_states[vid]["next_poll"] = now + timedelta(minutes=30)
-                    continue
-                try:
-                    process_truck(vid, truck_states.get(vid, {}), current_data, truck_states)
-                except Exception as e:
-                    log.error(f"Error processing truck {vid}: {e}")
+            # Step 3: Process due trucks (in parallel; each touches only its own state)
+            try:
+                # One query for every pending stop flag instead of one per truck
+                pending = get_pending_flags_by_vehicle() if due_trucks else {}
+                offline_next_poll = now + timedelta(minutes=30)
+                futures = []
+                for vid in due_trucks:
+                    current_data = all_trucks.get(vid)
+                    if current_data is None:
+                        # Not in this Samsara payload: retry in 30 min
+                        state = truck_states[vid]
+                        state["next_poll"] = offline_next_poll
+                        save_truck_state(state)
+                        continue
+                    futures.append(pool.submit(_process_one, vid, current_data,
+                                               pending.get(vid, [])))
+                for f in futures:
+                    f.result()
+            finally:
+                # Back on the heap at their new next_poll; trucks that failed
+                # (in _process_one or anywhere in this step) get a backoff
+                for vid in due_trucks:
+                    _backoff_if_still_due(vid, now)
+                    _schedule(vid)
 
             # Step 4: Add new trucks
-            for truck in all_trucks:
-                vid = truck["vehicle_id"]
+            for vid, truck in all_trucks.items():
                 if vid not in truck_states:
                     log.info(f"   New truck discovered: {truck['vehicle_name']} ({vid})")
-                    process_truck(vid, {}, truck, truck_states)
-
-            # Step 5: Periodic DB save
-            if (now - last_db_save).total_seconds() >= STATE_SAVE_INTERVAL_SECONDS:
-                save_all_truck_states(truck_states)
-                last_db_save = now
+                    try:
+                        process_truck(vid, {}, truck, truck_states)
+                        save_truck_state(truck_states[vid])
+                    finally:
+                        if vid in truck_states:
+                            _backoff_if_still_due(vid, now)
+                            _schedule(vid)
 
         except Exception as e:
-            log.error(f"Unhandled error in poll cycle: {e}", exc_info=True)
+            _log_error("Unhandled error in poll cycle", e)
 
-        time.sleep(30)
+        _stop.wait(_next_sleep())
 
+    pool.shutdown(wait=True)
+    stop_state_writer()
     log.info("FleetFuel Bot stopped cleanly.")
 
 
@@ -3,7 +3,11 @@ samsara_client.py  –  Fetch vehicle list, locations, and fuel levels from Sams
 Docs: https://developers.samsara.com/reference
 """
 
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import SAMSARA_API_TOKEN, SAMSARA_BASE_URL
 
 
@@ -12,10 +16,29 @@ HEADERS = {
     "Content-Type": "application/json",
 }
 
+# One keep-alive session for every Samsara call: reuses TCP/TLS connections
+# instead of a fresh handshake per request. GETs are retried on 429/5xx only;
+# a read timeout is not retried, so one slow request can't stall a poll for
+# several multiples of the 15 s timeout.
+_session = requests.Session()
+_session.headers.update(HEADERS)
+_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=None, connect=1, read=0, status=3, other=0,
+                      backoff_factor=0.3,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# The locations and stats calls are independent, as are driver lookups for
+# different vehicles: run them side by side so a poll waits for the slowest
+# request rather than the sum of all of them.
+_fetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="samsara")
+
 
 def _get(endpoint: str, params: dict = None) -> dict:
     url = f"{SAMSARA_BASE_URL}{endpoint}"
-    resp = requests.get(url, headers=HEADERS, params=params, timeout=15)
+    resp = _session.get(url, params=params, timeout=15)
     resp.raise_for_status()
     return resp.json()
 
@@ -36,26 +59,46 @@ def get_vehicle_locations() -> list[dict]:
     Uses Samsara v2 vehicles/locations endpoint.
     """
     url = "https://api.samsara.com/fleet/vehicles/locations"
-    resp = requests.get(url, headers=HEADERS, timeout=15)
+    resp = _session.get(url, timeout=15)
     resp.raise_for_status()
     data = resp.json()
     return data.get("data", [])
 
 
-def get_vehicle_stats(vehicle_ids: list[str] = None) -> list[dict]:
+# The stats feed is incremental: after the first call, passing the previous
+# endCursor as `after` returns only fuel readings newer than that cursor.
+# Latest reading per vehicle is kept here across polls, as (time, value).
+_FEED_URL = "https://api.samsara.com/fleet/vehicles/stats/feed"
+_feed_cursor: str | None = None
+_latest_fuel: dict[str, tuple[str, float]] = {}
+
+
+def _get_fuel_feed() -> list[dict]:
     """
-    Returns engine/fuel stats for vehicles using the FEED endpoint.
-    This returns a stream of fuel events, not just the latest snapshot.
-    Each item: { id, name, fuelPercents: [{value, time}, ...], ... }
+    Fuel events since the last call (all pages). On any error the cursor is
+    dropped, so the next call starts a fresh feed instead of skipping data.
     """
-    url = "https://api.samsara.com/fleet/vehicles/stats/feed"
+    global _feed_cursor
     params = {"types": "fuelPercents"}
-    if vehicle_ids:
-        params["vehicleIds"] = ",".join(vehicle_ids)
-    resp = requests.get(url, headers=HEADERS, params=params, timeout=15)
-    resp.raise_for_status()
-    data = resp.json()
-    return data.get("data", [])
+    if _feed_cursor:
+        params["after"] = _feed_cursor
+    items = []
+    try:
+        while True:
+            resp = _session.get(_FEED_URL, params=params, timeout=15)
+            resp.raise_for_status()
+            page = resp.json()
+            items.extend(page.get("data", []))
+            pagination = page.get("pagination", {})
+            if pagination.get("endCursor"):
+                params["after"] = pagination["endCursor"]
+            if not pagination.get("hasNextPage"):
+                break
+    except Exception:
+        _feed_cursor = None
+        raise
+    _feed_cursor = params.get("after")
+    return items
 
 
 def get_driver_for_vehicle(vehicle_id: str) -> dict | None:
@@ -65,7 +108,7 @@ def get_driver_for_vehicle(vehicle_id: str) -> dict | None:
     """
     try:
         url = f"https://api.samsara.com/fleet/vehicles/{vehicle_id}"
-        resp = requests.get(url, headers=HEADERS, timeout=15)
+        resp = _session.get(url, timeout=15)
         resp.raise_for_status()
         data = resp.json()
         driver = data.get("data", {}).get("currentDriver")
@@ -74,10 +117,43 @@ def get_driver_for_vehicle(vehicle_id: str) -> dict | None:
         return None
 
 
-def get_combined_vehicle_data() -> list[dict]:
+# Driver assignments change per shift, not per poll: remember each vehicle's
+# driver name for a few minutes instead of one GET per vehicle per poll.
+# get_driver_for_vehicle() returns None for a failed request as well as for
+# no driver, so a None is only kept briefly and retried on a later poll.
+_DRIVER_TTL_SECONDS      = 300
+_DRIVER_MISS_TTL_SECONDS = 30
+_driver_cache: dict[str, tuple[str | None, float]] = {}   # vid -> (name, expires_at)
+
+
+def _driver_cached(vehicle_id: str, now: float) -> bool:
+    cached = _driver_cache.get(vehicle_id)
+    return cached is not None and now < cached[1]
+
+
+def _get_driver_name(vehicle_id: str) -> str | None:
+    """Driver name for a vehicle, served from _driver_cache while fresh."""
+    now = time.monotonic()
+    if _driver_cached(vehicle_id, now):
+        return _driver_cache[vehicle_id][0]
+    driver = get_driver_for_vehicle(vehicle_id)
+    name = driver.get("name") if driver else None
+    ttl = _DRIVER_TTL_SECONDS if name else _DRIVER_MISS_TTL_SECONDS
+    _driver_cache[vehicle_id] = (name, now + ttl)
+    return name
+
+
+def _prefetch_driver_names(vehicle_ids: list[str]):
+    """Refresh stale _driver_cache entries concurrently."""
+    now = time.monotonic()
+    stale = [vid for vid in vehicle_ids if not _driver_cached(vid, now)]
+    list(_fetch_pool.map(_get_driver_name, stale))
+
+
+def get_combined_vehicle_data() -> dict[str, dict]:
     """
-    Merges locations + fuel stats into one list.
-    Returns list of:
+    Merges locations + fuel stats, keyed by vehicle_id (in API order).
+    Returns {vehicle_id: record}, each record:
     {
         vehicle_id:   str,
         vehicle_name: str,
@@ -89,24 +165,38 @@ def get_combined_vehicle_data() -> list[dict]:
         fuel_pct:     float,   # 0-100
     }
     """
-    locations_raw = get_vehicle_locations()
-    stats_raw     = get_vehicle_stats()
+    locations_job = _fetch_pool.submit(get_vehicle_locations)
+    stats_raw     = _get_fuel_feed()
+    locations_raw = locations_job.result()
 
-    # Index stats by vehicle id
-    stats_map = {}
+    # Fold new fuel events into the latest reading per vehicle
     for s in stats_raw:
         vid = s.get("id")
-        fuel_events = s.get("fuelPercents", [])
-        
-        if vid and fuel_events:
-            # Get the LATEST fuel reading from the feed
-            latest = max(fuel_events, key=lambda x: x.get("time", ""))
-            stats_map[vid] = float(latest.get("value", 100))
-        elif vid:
-            # No fuel events means no data, default to 100
-            stats_map[vid] = 100.0
-
-    results = []
+
+        # Get the LATEST fuel reading from the feed (one pass, first wins ties).
+        # Events with a null value carry no fuel level and are skipped.
+        reading = None
+        for ev in s.get("fuelPercents", []):
+            if ev.get("value") is None:
+                continue
+            t = ev.get("time", "")
+            if reading is None or t > reading[0]:
+                reading = (t, float(ev["value"]))
+
+        if vid and reading:
+            if vid not in _latest_fuel or reading[0] >= _latest_fuel[vid][0]:
+                _latest_fuel[vid] = reading
+        elif vid and vid not in _latest_fuel:
+            # No fuel readings means no data, default to 100
+            _latest_fuel[vid] = ("", 100.0)
+
+    _prefetch_driver_names([
+        v.get("id") for v in locations_raw
+        if v.get("location", {}).get("latitude") is not None
+        and v.get("location", {}).get("longitude") is not None
+    ])
+
+    results = {}
     for v in locations_raw:
         vid  = v.get("id")
         name = v.get("name", vid)
@@ -119,13 +209,12 @@ def get_combined_vehicle_data() -> list[dict]:
         if lat is None or lng is None:
             continue  # skip vehicles with no GPS fix
 
-        fuel_pct = stats_map.get(vid, 100.0)
+        fuel_pct = _latest_fuel.get(vid, ("", 100.0))[1]
 
-        # Try to get driver name (optional — adds an extra API call per vehicle)
-        driver = get_driver_for_vehicle(vid)
-        driver_name = driver.get("name") if driver else None
+        # Driver name (optional — one API call per vehicle every _DRIVER_TTL_SECONDS)
+        driver_name = _get_driver_name(vid)
 
-        results.append({
+        results[vid] = {
             "vehicle_id":   vid,
             "vehicle_name": name,
             "driver_name":  driver_name,
@@ -134,6 +223,6 @@ def get_combined_vehicle_data() -> list[dict]:
             "heading":      float(heading),
             "speed_mph":    float(speed_mph),
             "fuel_pct":     fuel_pct,
-        })
+        }
 
     return results
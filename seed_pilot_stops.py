@@ -25,8 +25,10 @@ Options:
 
 import argparse
 import csv
+import itertools
 import sys
-from database import init_db, upsert_pilot_stop
+from functools import partial
+from database import init_db, upsert_pilot_stops_bulk
 
 
 # -- Column maps --------------------------------------------------------------
@@ -90,6 +92,9 @@ GENERIC_COLUMN_MAP = {
 
 REQUIRED = {"name", "latitude", "longitude"}
 
+# Mapped rows per upsert_pilot_stops_bulk() call (one transaction each)
+BATCH_SIZE = 1000
+
 DEFAULTS = {
     "brand":      "Pilot",
     "address":    "",
@@ -120,20 +125,39 @@ def _detect_format(headers):
     return "generic"
 
 
-def _map_pilot_row(raw: dict, store_number: str = "") -> dict | None:
+def _column_plan(headers, column_map) -> tuple[list, dict]:
+    """
+    Per-file column plan: [(index, db_field)] for every header column_map
+    knows, plus {header: index} for the name columns. Headers are normalised
+    once per file here, so rows stay plain lists instead of dicts.
+    """
+    fields = []
+    for i, h in enumerate(headers):
+        db_field = column_map.get(h.strip().lower())
+        if db_field:
+            fields.append((i, db_field))
+    return fields, {h: i for i, h in enumerate(headers)}
+
+
+def _cell(row: list, index: dict, header: str) -> str:
+    i = index.get(header)
+    return row[i] if i is not None else ""
+
+
+def _map_pilot_row(row: list, plan: tuple) -> dict | None:
     """Map a Pilot/Flying J CSV row to DB fields."""
+    fields, index = plan
     mapped = dict(DEFAULTS)
     mapped["brand"] = "Pilot"
 
-    for col, val in raw.items():
-        key = col.strip().lower()
-        db_field = PILOT_COLUMN_MAP.get(key)
-        if db_field and val:
-            mapped[db_field] = str(val).strip()
+    for i, db_field in fields:
+        val = row[i]
+        if val:
+            mapped[db_field] = val.strip()
 
     # Build name from Store # + Name
-    store_num = str(raw.get("Store #", "") or "").strip()
-    store_name = str(raw.get("Name", "") or "").strip()
+    store_num  = _cell(row, index, "Store #").strip()
+    store_name = _cell(row, index, "Name").strip()
     if store_num and store_name:
         mapped["name"] = f"{store_name} #{store_num}"
     elif store_name:
@@ -144,20 +168,20 @@ def _map_pilot_row(raw: dict, store_number: str = "") -> dict | None:
     return _validate_and_coerce(mapped)
 
 
-def _map_loves_row(raw: dict) -> dict | None:
+def _map_loves_row(row: list, plan: tuple) -> dict | None:
     """Map a Love's CSV row to DB fields."""
+    fields, index = plan
     mapped = dict(DEFAULTS)
     mapped["brand"] = "Love's"
 
-    for col, val in raw.items():
-        key = col.strip().lower()
-        db_field = LOVES_COLUMN_MAP.get(key)
-        if db_field and val is not None and str(val).strip():
-            mapped[db_field] = str(val).strip()
+    for i, db_field in fields:
+        val = row[i].strip()
+        if val:
+            mapped[db_field] = val
 
     # Build name from store_name + StoreNumber
-    store_name = str(raw.get("store_name", "") or "").strip()
-    store_num  = str(raw.get("StoreNumber", "") or "").strip()
+    store_name = _cell(row, index, "store_name").strip()
+    store_num  = _cell(row, index, "StoreNumber").strip()
     if store_name and store_num:
         mapped["name"] = f"{store_name} #{store_num}"
     elif store_name:
@@ -172,16 +196,16 @@ def _map_loves_row(raw: dict) -> dict | None:
     return _validate_and_coerce(mapped)
 
 
-def _map_generic_row(raw: dict, default_brand: str = "Pilot") -> dict | None:
+def _map_generic_row(row: list, plan: tuple, default_brand: str = "Pilot") -> dict | None:
     """Map a generic CSV row using flexible column name matching."""
+    fields, _ = plan
     mapped = dict(DEFAULTS)
     mapped["brand"] = default_brand
 
-    for col, val in raw.items():
-        key = col.strip().lower()
-        db_field = GENERIC_COLUMN_MAP.get(key)
-        if db_field and val is not None and str(val).strip():
-            mapped[db_field] = str(val).strip()
+    for i, db_field in fields:
+        val = row[i].strip()
+        if val:
+            mapped[db_field] = val
 
     return _validate_and_coerce(mapped)
 
@@ -205,70 +229,109 @@ def _validate_and_coerce(mapped: dict) -> dict | None:
 
 # -- Main seeder --------------------------------------------------------------
 
+def _flush_batch(batch: list) -> tuple[int, int]:
+    """
+    Upsert and clear a batch in one executemany/transaction. If that fails,
+    retry row by row so one bad row only costs itself. Returns (ok, failed).
+    """
+    if not batch:
+        return 0, 0
+    rows = batch[:]
+    batch.clear()
+    try:
+        return upsert_pilot_stops_bulk(rows), 0
+    except Exception as e:
+        print(f"  Bulk upsert of {len(rows)} rows failed ({e}); retrying row by row")
+    ok = failed = 0
+    for row in rows:
+        try:
+            ok += upsert_pilot_stops_bulk([row])
+        except Exception as e:
+            failed += 1
+            if failed <= 3:
+                print(f"  Row {row.get('name')!r} error: {e}")
+    return ok, failed
+
+
 def seed(filepath: str, brand_override: str, dry_run: bool, delimiter: str):
     if not dry_run:
         print("Initializing database...")
         init_db()
 
-    with open(filepath, newline="", encoding="utf-8-sig") as f:
-        reader = csv.DictReader(f, delimiter=delimiter)
-        rows   = list(reader)
-
-    if not rows:
-        print("No rows found in CSV.")
-        return
-
-    headers    = list(rows[0].keys())
-    fmt        = _detect_format(headers) if not brand_override else brand_override.lower()
-    print(f"CSV file:  {filepath}")
-    print(f"Format:    {fmt}")
-    print(f"Rows:      {len(rows)}")
-    print(f"Headers:   {headers}")
-
-    if dry_run:
-        print("\nDRY RUN - first 5 rows:")
-        for raw in rows[:5]:
-            if fmt == "loves":
-                mapped = _map_loves_row(raw)
-            elif fmt in ("pilot", "flying j"):
-                mapped = _map_pilot_row(raw)
-            else:
-                mapped = _map_generic_row(raw, brand_override or "Pilot")
-            status = "OK" if mapped else "SKIP"
-            print(f"  [{status}] {mapped or raw}")
-        return
-
     inserted = 0
     skipped  = 0
     errors   = 0
+    batch    = []
 
-    for i, raw in enumerate(rows, 1):
-        try:
-            if fmt == "loves":
-                mapped = _map_loves_row(raw)
-            elif fmt in ("pilot", "flying j"):
-                mapped = _map_pilot_row(raw)
-            else:
-                mapped = _map_generic_row(raw, brand_override or "Pilot")
-
-            if mapped is None:
-                skipped += 1
-                if skipped <= 3:
-                    print(f"  Row {i} skipped (missing name/lat/lng): {raw}")
-                continue
-
-            upsert_pilot_stop(mapped)
-            inserted += 1
-
-        except Exception as e:
-            errors += 1
-            if errors <= 3:
-                print(f"  Row {i} error: {e}")
-
-        if i % 200 == 0:
-            print(f"  ... {i}/{len(rows)} processed")
+    # Rows are streamed from the file: only the current batch is held in memory
+    with open(filepath, newline="", encoding="utf-8-sig") as f:
+        reader  = csv.reader(f, delimiter=delimiter)
+        headers = next(reader, None) or []
+        rows    = (r for r in reader if r)   # blank lines, as DictReader skips them
+        first   = next(rows, None)
+
+        if first is None:
+            print("No rows found in CSV.")
+            return
+
+        fmt        = _detect_format(headers) if not brand_override else brand_override.lower()
+        print(f"CSV file:  {filepath}")
+        print(f"Format:    {fmt}")
+        print(f"Headers:   {headers}")
+
+        # Mapper and column plan are fixed for the whole file: pick them once
+        if fmt == "loves":
+            mapper = partial(_map_loves_row, plan=_column_plan(headers, LOVES_COLUMN_MAP))
+        elif fmt in ("pilot", "flying j"):
+            mapper = partial(_map_pilot_row, plan=_column_plan(headers, PILOT_COLUMN_MAP))
+        else:
+            mapper = partial(_map_generic_row, plan=_column_plan(headers, GENERIC_COLUMN_MAP),
+                             default_brand=brand_override or "Pilot")
+
+        width = len(headers)
+        rows  = itertools.chain([first], rows)
+
+        if dry_run:
+            print("\nDRY RUN - first 5 rows:")
+            for raw in itertools.islice(rows, 5):
+                raw += [""] * (width - len(raw))
+                mapped = mapper(raw)
+                status = "OK" if mapped else "SKIP"
+                print(f"  [{status}] {mapped or dict(zip(headers, raw))}")
+            return
+
+        for i, raw in enumerate(rows, 1):
+            try:
+                raw += [""] * (width - len(raw))   # short rows, as DictReader pads them
+                mapped = mapper(raw)
+
+                if mapped is None:
+                    skipped += 1
+                    if skipped <= 3:
+                        print(f"  Row {i} skipped (missing name/lat/lng): {dict(zip(headers, raw))}")
+                    continue
+
+                batch.append(mapped)
+
+            except Exception as e:
+                errors += 1
+                if errors <= 3:
+                    print(f"  Row {i} error: {e}")
+
+            if len(batch) >= BATCH_SIZE:
+                ok, failed = _flush_batch(batch)
+                inserted += ok
+                errors   += failed
+
+            if i % 200 == 0:
+                print(f"  ... {i} processed")
+
+    ok, failed = _flush_batch(batch)
+    inserted += ok
+    errors   += failed
 
     print(f"\nDone!")
+    print(f"  Rows read        : {i}")
     print(f"  Inserted/updated : {inserted}")
     print(f"  Skipped          : {skipped}")
     print(f"  Errors           : {errors}")
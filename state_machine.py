@@ -46,8 +46,7 @@ from telegram_bot import (
 )
 from database import (
     create_fuel_alert,
-    create_stop_assignment,
-    create_pending_flag,
+    create_full_alert,
     get_pending_flags_for_vehicle,
     mark_flag_visited,
     mark_flag_skipped,
@@ -132,7 +131,11 @@ def _clear_alert(state, skipped_stop_id=None):
 
 # ── Main entry point ──────────────────────────────────────────────────────────
 
-def process_truck(vid, prev_state, current_data, truck_states):
+def process_truck(vid, prev_state, current_data, truck_states, pending_flags=None):
+    """
+    pending_flags: this truck's pending stop flags if the caller prefetched
+    them (see get_pending_flags_by_vehicle); None means query on demand.
+    """
 
     fuel    = current_data["fuel_pct"]
     speed   = current_data["speed_mph"]
@@ -142,10 +145,9 @@ def process_truck(vid, prev_state, current_data, truck_states):
     vname   = current_data["vehicle_name"]
     driver  = current_data["driver_name"]
 
-    if vid not in truck_states:
-        truck_states[vid] = _new_state(vid, current_data)
-
-    state = truck_states[vid]
+    state = truck_states.get(vid)
+    if state is None:
+        state = truck_states[vid] = _new_state(vid, current_data)
 
     state["vehicle_name"] = vname
     state["driver_name"]  = driver
@@ -255,7 +257,7 @@ def process_truck(vid, prev_state, current_data, truck_states):
         state["parked_since"] = None
 
         # Check flags (near stop = visited while moving, old flag = skipped)
-        _check_flags(vid, state, lat, lng, fuel, vname, driver)
+        _check_flags(vid, state, lat, lng, fuel, vname, driver, pending_flags)
 
         # Fire alert only once per trip leg
         if not state.get("alert_sent"):
@@ -304,15 +306,13 @@ def _fire_alert(vid, state, data):
 
     log.info(f"   {vname}: firing alert — fuel={fuel:.1f}%")
 
-    alert_id = create_fuel_alert(vid, vname, driver, fuel, lat, lng, heading, speed)
-    state["open_alert_id"] = alert_id
-
     skipped_ids = state.get("skipped_stop_ids", set())
     stop, stop_type = find_best_stop(lat, lng, heading, speed, exclude_stop_ids=skipped_ids)
 
     if stop_type == StopType.AT_STOP:
         # Truck is physically in a stop's parking lot right now
         log.info(f"   {vname}: already in lot of {stop['name']} — no alert")
+        alert_id = create_fuel_alert(vid, vname, driver, fuel, lat, lng, heading, speed)
         resolve_alert(alert_id)
         state["open_alert_id"] = None
         state["alert_sent"]    = True
@@ -320,6 +320,8 @@ def _fire_alert(vid, state, data):
 
     if stop is None or stop_type == StopType.NONE:
         log.warning(f"   {vname}: no stop within 80 miles")
+        alert_id = create_fuel_alert(vid, vname, driver, fuel, lat, lng, heading, speed)
+        state["open_alert_id"] = alert_id
         msg_id = send_no_stop_alert(vname, driver, fuel, lat, lng, heading, speed)
         if msg_id:
             update_alert_telegram_msg(alert_id, msg_id)
@@ -328,8 +330,9 @@ def _fire_alert(vid, state, data):
 
     log.info(f"   {vname}: -> {stop['name']} {stop['distance_miles']:.1f} mi [{stop_type.value}]")
 
-    create_stop_assignment(alert_id, stop["id"], stop["distance_miles"])
-    create_pending_flag(alert_id, vid, stop["id"])
+    alert_id, _, _ = create_full_alert(vid, vname, driver, fuel, lat, lng, heading, speed,
+                                       stop["id"], stop["distance_miles"])
+    state["open_alert_id"] = alert_id
 
     state["assigned_stop_id"]   = stop["id"]
     state["assigned_stop_name"] = stop["name"]
@@ -346,7 +349,7 @@ def _fire_alert(vid, state, data):
 
 # ── Flag check (moving trucks only) ──────────────────────────────────────────
 
-def _check_flags(vid, state, lat, lng, fuel, vname, driver):
+def _check_flags(vid, state, lat, lng, fuel, vname, driver, flags=None):
     """
     Check if truck visited or skipped assigned stop.
 
@@ -355,7 +358,8 @@ def _check_flags(vid, state, lat, lng, fuel, vname, driver):
 
     Never marks as refueled based on proximity alone - fuel must go UP.
     """
-    flags = get_pending_flags_for_vehicle(vid)
+    if flags is None:
+        flags = get_pending_flags_for_vehicle(vid)
     if not flags:
         return
 
@@ -4,22 +4,51 @@ telegram_bot.py  –  Telegram messages for FleetFuel bot.
 
 import time
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from config import TELEGRAM_BOT_TOKEN, TELEGRAM_GROUP_ID
 
 log = logging.getLogger(__name__)
 BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 
+# Keep-alive session so alerts reuse one TLS connection to api.telegram.org.
+# No adapter-level retries: _post() handles 429 retry_after itself.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+# Telegram allows about one message per second into a chat. Alerts are sent
+# from several truck threads at once, so space requests out here instead of
+# bursting and then sleeping through 429 retry_after penalties.
+_MIN_SEND_INTERVAL_SECONDS = 1.0
+_pace_lock    = threading.Lock()
+_next_send_at = 0.0
+
+
+def _pace():
+    """Block until this thread's turn to send."""
+    global _next_send_at
+    with _pace_lock:
+        now  = time.monotonic()
+        wait = _next_send_at - now
+        _next_send_at = max(now, _next_send_at) + _MIN_SEND_INTERVAL_SECONDS
+    if wait > 0:
+        time.sleep(wait)
+
 
 def _post(method: str, payload: dict, retries: int = 4) -> dict | None:
+    global _next_send_at
     for attempt in range(retries + 1):
+        _pace()
         try:
-            resp = requests.post(f"{BASE_URL}/{method}", json=payload, timeout=10)
+            resp = _session.post(f"{BASE_URL}/{method}", json=payload, timeout=10)
             if resp.status_code == 429:
                 wait = max(resp.json().get("parameters", {}).get("retry_after", 5), 5)
                 wait *= (attempt + 1)
                 log.warning(f"Telegram 429 — waiting {wait}s (attempt {attempt+1})")
-                time.sleep(wait)
+                # Hold back every sender, not just this one; _pace() does the wait
+                with _pace_lock:
+                    _next_send_at = max(_next_send_at, time.monotonic() + wait)
                 continue
             resp.raise_for_status()
             return resp.json()
@@ -42,10 +71,12 @@ def _send(text: str) -> int | None:
     return None
 
 
+_COMPASS_POINTS = ("N","NNE","NE","ENE","E","ESE","SE","SSE",
+                   "S","SSW","SW","WSW","W","WNW","NW","NNW")
+
+
 def _compass(heading: float) -> str:
-    dirs = ["N","NNE","NE","ENE","E","ESE","SE","SSE",
-            "S","SSW","SW","WSW","W","WNW","NW","NNW"]
-    return dirs[round(heading / 22.5) % 16]
+    return _COMPASS_POINTS[round(heading / 22.5) % 16]
 
 
 def _stop_note(stop_type_value: str) -> str:
@@ -2,7 +2,9 @@
 truck_stop_finder.py  -  Find the nearest diesel stop for a truck.
 
 HOW IT WORKS:
-  - All Pilot, Flying J, and Love's stops loaded from SQLite DB
+  - Pilot, Flying J, and Love's stops near the truck loaded from SQLite DB
+    (bounding-box lookup in the pilot_stops_rtree R*Tree, not the whole table;
+    parked trucks get the nearest few with distances computed in SQL)
   - Distance calculated using GPS coordinates (haversine formula)
   - For MOVING trucks: prefer stops ahead of the truck (within 120 degree arc)
     If nothing found ahead, fall back to any direction (truck may need to turn around)
@@ -30,11 +32,13 @@ from config import (
     LOVES_RADIUS_MILES,
     EXTENDED_RADIUS_MILES,
 )
-from database import get_all_stops_with_diesel
+from database import get_stops_near, get_nearest_stops
 
 log = logging.getLogger(__name__)
 
 EARTH_RADIUS_MILES    = 3958.8
+_MILES_PER_DEG        = math.radians(EARTH_RADIUS_MILES)   # arc length of one degree
+_FLAT_EARTH_MAX_MILES = 5.0    # is_truck_near_stop: equirectangular below this radius
 _PARKED_SPEED_MPH     = 5      # truck is parked if speed <= this
 _AT_STOP_RADIUS_MILES = 0.35   # 0.35 mi ~ 600m = truck is in the lot (large truck stop properties)
 _AHEAD_MAX_DEGREES    = 120    # stops within this arc are considered "ahead"
@@ -81,65 +85,56 @@ def _angle_diff(a, b):
     return d if d <= 180 else 360 - d
 
 
-def _is_ahead(truck_heading, truck_lat, truck_lng, stop_lat, stop_lng):
-    """Return True if stop is within _AHEAD_MAX_DEGREES arc of truck heading."""
-    bear = _bearing(truck_lat, truck_lng, stop_lat, stop_lng)
-    return _angle_diff(truck_heading, bear) <= _AHEAD_MAX_DEGREES
+# -- Brand detection ----------------------------------------------------------
 
+# Lower-case brand substrings; also handed to SQL for the parked search
+_PILOT_BRANDS = ("pilot", "flying j", "flyingj", "one9")
+_LOVES_BRANDS = ("love",)
 
-# -- Brand detection ----------------------------------------------------------
 
 def _is_pilot(brand: str) -> bool:
     b = brand.lower()
-    return "pilot" in b or "flying j" in b or "flyingj" in b or "one9" in b
+    return any(p in b for p in _PILOT_BRANDS)
 
 
 def _is_loves(brand: str) -> bool:
-    return "love" in brand.lower()
-
-
-def _is_any(brand: str) -> bool:
-    return _is_pilot(brand) or _is_loves(brand)
+    b = brand.lower()
+    return any(p in b for p in _LOVES_BRANDS)
 
 
 # -- Core search --------------------------------------------------------------
 
-def _find_nearest(stops, truck_lat, truck_lng, radius_miles,
-                  brand_check, truck_heading=None):
+def _measure_stops(stops, truck_lat, truck_lng, truck_heading):
     """
-    Find matching stops within radius, sorted by distance.
+    Distance and ahead/behind for every stop in one pass.
 
-    If truck_heading is provided, only returns stops AHEAD of the truck
-    (within _AHEAD_MAX_DEGREES arc). If no stops found ahead, returns empty list
-    so caller can fall back to any-direction search.
+    Returns [(stop, distance_miles, ahead)]. The truck-side terms of the
+    haversine and bearing formulas are computed once, not once per stop, and
+    each stop is measured once no matter how many brand/radius passes follow.
     """
-    candidates = []
+    phi1     = math.radians(truck_lat)
+    lam1     = math.radians(truck_lng)
+    cos_phi1 = math.cos(phi1)
+    sin_phi1 = math.sin(phi1)
+    radians, cos, sin = math.radians, math.cos, math.sin
 
+    measured = []
     for stop in stops:
-        brand = stop.get("brand", "")
-        if not brand_check(brand):
-            continue
+        # Each stop coordinate is converted once; the deltas reuse it
+        phi2     = radians(stop["latitude"])
+        cos_phi2 = cos(phi2)
+        dphi     = phi2 - phi1
+        dlam     = radians(stop["longitude"]) - lam1
 
-        slat = float(stop["latitude"])
-        slng = float(stop["longitude"])
-        dist = haversine_miles(truck_lat, truck_lng, slat, slng)
+        a = sin(dphi / 2) ** 2 + cos_phi1 * cos_phi2 * sin(dlam / 2) ** 2
+        dist = EARTH_RADIUS_MILES * 2 * math.asin(math.sqrt(a))
 
-        if dist > radius_miles:
-            continue
+        x = sin(dlam) * cos_phi2
+        y = cos_phi1 * sin(phi2) - sin_phi1 * cos_phi2 * cos(dlam)
+        bear = (math.degrees(math.atan2(x, y)) + 360) % 360
 
-        # If heading provided, skip stops behind the truck
-        if truck_heading is not None:
-            if not _is_ahead(truck_heading, truck_lat, truck_lng, slat, slng):
-                continue
-
-        candidates.append({
-            **stop,
-            "distance_miles":  round(dist, 2),
-            "google_maps_url": f"https://maps.google.com/?q={slat},{slng}",
-        })
-
-    candidates.sort(key=lambda s: s["distance_miles"])
-    return candidates
+        measured.append((stop, dist, _angle_diff(truck_heading, bear) <= _AHEAD_MAX_DEGREES))
+    return measured
 
 
 # -- Public API ---------------------------------------------------------------
@@ -157,52 +152,56 @@ def find_best_stop(truck_lat: float, truck_lng: float,
 
     Returns (stop_dict, StopType) or (None, StopType.NONE).
     """
-    all_stops = get_all_stops_with_diesel()
-
-    # Filter out previously skipped stops
+    exclude_stop_ids = exclude_stop_ids or set()
     if exclude_stop_ids:
-        all_stops = [s for s in all_stops if s.get("id") not in exclude_stop_ids]
-        if exclude_stop_ids:
-            log.info(f"Stop finder: excluding {len(exclude_stop_ids)} skipped stop(s)")
+        log.info(f"Stop finder: excluding {len(exclude_stop_ids)} skipped stop(s)")
     parked    = speed_mph <= _PARKED_SPEED_MPH
 
     # -------------------------------------------------------------------------
-    # Already at a stop? Find the single nearest stop (any brand) and check
-    # if truck is within AT_STOP radius. Checks Pilot AND Love's equally.
+    # PARKED: nearest stop any brand, any direction. SQLite computes the
+    # distances and returns only the closest few; the first eligible one is
+    # either the lot the truck is already in, or the stop to send it to.
     # -------------------------------------------------------------------------
     if parked:
-        # Find nearest stop of any brand, sorted by distance
-        nearest = _find_nearest(all_stops, truck_lat, truck_lng,
-                                _AT_STOP_RADIUS_MILES, _is_any)
-        if nearest:
-            stop = nearest[0]  # closest one
-            slat = float(stop["latitude"])
-            slng = float(stop["longitude"])
-            dist = haversine_miles(truck_lat, truck_lng, slat, slng)
+        # Skipped stops and other brands are filtered in SQL, before the LIMIT
+        results = get_nearest_stops(truck_lat, truck_lng, EXTENDED_RADIUS_MILES, 1,
+                                    exclude_ids=exclude_stop_ids,
+                                    brands=_PILOT_BRANDS + _LOVES_BRANDS)
+        if not results:
+            log.warning("Stop finder [PARKED]: nothing within 80 miles")
+            return None, StopType.NONE
+
+        stop = results[0]
+        slat = float(stop["latitude"])
+        slng = float(stop["longitude"])
+        dist = stop.pop("dist_miles")
+        best = {
+            **stop,
+            "google_maps_url": f"https://maps.google.com/?q={slat},{slng}",
+        }
+
+        # Already at a stop? Checks Pilot AND Love's equally.
+        if dist <= _AT_STOP_RADIUS_MILES:
             log.info(
                 f"Stop finder: truck already at {stop['name']} "
                 f"({dist * 5280:.0f} ft away) - no alert needed"
             )
-            return {
-                **stop,
-                "distance_miles":  round(dist, 3),
-                "google_maps_url": f"https://maps.google.com/?q={slat},{slng}",
-            }, StopType.AT_STOP
+            best["distance_miles"] = round(dist, 3)
+            return best, StopType.AT_STOP
 
-    # -------------------------------------------------------------------------
-    # PARKED: nearest stop any brand, any direction
-    # -------------------------------------------------------------------------
-    if parked:
-        results = _find_nearest(all_stops, truck_lat, truck_lng,
-                                EXTENDED_RADIUS_MILES, _is_any)
-        if results:
-            best = results[0]
-            log.info(f"Stop finder [PARKED]: {best['name']} "
-                     f"{best['distance_miles']:.1f} mi "
-                     f"brand={best.get('brand', '?')}")
-            return best, StopType.NEAREST
-        log.warning("Stop finder [PARKED]: nothing within 80 miles")
-        return None, StopType.NONE
+        best["distance_miles"] = round(dist, 2)
+        log.info(f"Stop finder [PARKED]: {best['name']} "
+                 f"{best['distance_miles']:.1f} mi "
+                 f"brand={best.get('brand', '?')}")
+        return best, StopType.NEAREST
+
+    # Only stops inside the widest search radius can ever be returned
+    search_radius = max(PILOT_RADIUS_MILES, LOVES_RADIUS_MILES, EXTENDED_RADIUS_MILES)
+    all_stops = get_stops_near(truck_lat, truck_lng, search_radius)
+
+    # Filter out previously skipped stops
+    if exclude_stop_ids:
+        all_stops = [s for s in all_stops if s.get("id") not in exclude_stop_ids]
 
     # -------------------------------------------------------------------------
     # MOVING: brand priority, prefer ahead, fallback to any direction
@@ -214,51 +213,57 @@ def find_best_stop(truck_lat: float, truck_lng: float,
     # But a stop 5 mi behind beats a stop 25 mi ahead
     # Handles wrong heading data from Samsara gracefully
 
+    measured = _measure_stops(all_stops, truck_lat, truck_lng, truck_heading)
+
     def _scored_search(brand_check, radius):
-        candidates = _find_nearest(all_stops, truck_lat, truck_lng,
-                                   radius, brand_check)
-        if not candidates:
-            return []
-        for c in candidates:
-            slat = float(c["latitude"])
-            slng = float(c["longitude"])
-            ahead = _is_ahead(truck_heading, truck_lat, truck_lng, slat, slng)
-            # Penalty for stops behind the truck
-            c["_score"] = c["distance_miles"] if ahead else c["distance_miles"] + 15
-        candidates.sort(key=lambda s: s["_score"])
-        return candidates
+        """(candidate, ahead) for the best matching stop within radius, or None."""
+        # Score as plain tuples; only the winner is copied into a result dict
+        best = None
+        for stop, dist, ahead in measured:
+            if dist > radius or not brand_check(stop.get("brand", "")):
+                continue
+            distance = round(dist, 2)
+            # Penalty for stops behind the truck; ties go to the nearer stop
+            key = (distance if ahead else distance + 15, distance)
+            if best is None or key < best[0]:
+                best = (key, stop, ahead)
+        if best is None:
+            return None
+        (score, distance), stop, ahead = best
+        return {
+            **stop,
+            "distance_miles":  distance,
+            "google_maps_url": f"https://maps.google.com/?q={stop['latitude']},{stop['longitude']}",
+            "_score":          score,
+        }, ahead
 
     # 1. Pilot within 50 mi
-    results = _scored_search(_is_pilot, PILOT_RADIUS_MILES)
-    if results:
-        best = results[0]
-        ahead = _is_ahead(truck_heading, truck_lat, truck_lng,
-                          float(best["latitude"]), float(best["longitude"]))
+    result = _scored_search(_is_pilot, PILOT_RADIUS_MILES)
+    if result:
+        best, ahead = result
         log.info(f"Stop finder: Pilot '{best['name']}' {best['distance_miles']:.1f} mi "+
                  ("ahead" if ahead else "(behind - nearest option)"))
         return best, StopType.PILOT_50
 
     # 2. Love's within 50 mi
-    results = _scored_search(_is_loves, LOVES_RADIUS_MILES)
-    if results:
-        best = results[0]
-        ahead = _is_ahead(truck_heading, truck_lat, truck_lng,
-                          float(best["latitude"]), float(best["longitude"]))
+    result = _scored_search(_is_loves, LOVES_RADIUS_MILES)
+    if result:
+        best, ahead = result
         log.info(f"Stop finder: Love's '{best['name']}' {best['distance_miles']:.1f} mi "+
                  ("ahead" if ahead else "(behind - nearest option)"))
         return best, StopType.LOVES_50
 
     # 3. Pilot within 80 mi
-    results = _scored_search(_is_pilot, EXTENDED_RADIUS_MILES)
-    if results:
-        best = results[0]
+    result = _scored_search(_is_pilot, EXTENDED_RADIUS_MILES)
+    if result:
+        best, _ = result
         log.info(f"Stop finder: Pilot '{best['name']}' {best['distance_miles']:.1f} mi (extended)")
         return best, StopType.PILOT_80
 
     # 4. Love's within 80 mi
-    results = _scored_search(_is_loves, EXTENDED_RADIUS_MILES)
-    if results:
-        best = results[0]
+    result = _scored_search(_is_loves, EXTENDED_RADIUS_MILES)
+    if result:
+        best, _ = result
         log.info(f"Stop finder: Love's '{best['name']}' {best['distance_miles']:.1f} mi (extended)")
         return best, StopType.LOVES_80
 
@@ -267,5 +272,15 @@ def find_best_stop(truck_lat: float, truck_lng: float,
 
 
 def is_truck_near_stop(truck_lat, truck_lng, stop_lat, stop_lng, radius_miles):
-    """Return True if truck is within radius_miles of the given stop."""
-    return haversine_miles(truck_lat, truck_lng, stop_lat, stop_lng) <= radius_miles
+    """
+    Return True if truck is within radius_miles of the given stop.
+    Visit checks use a sub-mile radius, where a flat-earth (equirectangular)
+    squared distance matches haversine to well under 0.1% without asin/sqrt.
+    """
+    dy = (stop_lat - truck_lat) * _MILES_PER_DEG
+    if abs(dy) > radius_miles:
+        return False
+    if radius_miles > _FLAT_EARTH_MAX_MILES:
+        return haversine_miles(truck_lat, truck_lng, stop_lat, stop_lng) <= radius_miles
+    dx = (stop_lng - truck_lng) * _MILES_PER_DEG * math.cos(math.radians(truck_lat))
+    return dx * dx + dy * dy <= radius_miles * radius_miles